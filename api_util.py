@@ -1,14 +1,526 @@
 import os.path
-from functools import lru_cache
+import re
+import json
+import time
+import random
+import shutil
+import hashlib
+import inspect
+import atexit
+import tempfile
+import threading
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 
 import argparse
+import urllib3
+from tqdm import tqdm
 import tator
-from tator.openapi.tator_openapi.models import Project, Media, LocalizationType, Version, User
+from tator.openapi.tator_openapi import ApiClient
+from tator.openapi.tator_openapi.rest import RESTClientObject, RESTResponse
+from tator.openapi.tator_openapi.exceptions import ApiException
+from tator.openapi.tator_openapi.models import Project, Media, LocalizationType, Version
+
+# On-disk metadata cache, shared by every process (eg slurm array tasks) that uses api_util getters
+CACHE_DIR = os.environ.get('TATOR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'tator_scripts'))
+CACHE_TTL = float(os.environ.get('TATOR_CACHE_TTL', 6*60*60))  # seconds. 0 disables the on-disk cache
+# ProjectSnapshot file(s) to serve type/version/section lookups from, eg one shipped to slurm workers. Colon separated.
+SNAPSHOT_FILES = os.environ.get('TATOR_SNAPSHOT', '')
+
+DEFAULT_WORKERS = 4
 
 def read_token(token_file):
     with open(token_file) as f:
         return f.read().strip()
 
+
+class ApiSession:
+    """ Wraps a TatorApi. Every API call gets a request timeout and transient failures
+        (429/5xx responses, connection resets and timeouts) are retried with exponential backoff and jitter.
+        Non-get_* calls are only retried when the server cannot have acted on them (429, 503, no connection).
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    UNSENT_STATUSES = {429, 503}
+
+    def __init__(self, api, retries=5, backoff=2, backoff_max=120, timeout=(10, 300), metrics=None):
+        self._api = api
+        self._retries = retries
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._timeout = timeout
+        self._metrics = metrics
+
+    def _retryable(self, func_name, error):
+        if isinstance(error, ApiException):
+            statuses = self.RETRY_STATUSES if func_name.startswith('get_') else self.UNSENT_STATUSES
+            return error.status in statuses
+        if isinstance(error, urllib3.exceptions.MaxRetryError) and error.reason is not None:
+            error = error.reason
+        if isinstance(error, urllib3.exceptions.NewConnectionError):
+            return True
+        return func_name.startswith('get_') and isinstance(error, (urllib3.exceptions.HTTPError, ConnectionError))
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            kwargs.setdefault('_request_timeout', self._timeout)
+            for attempt in range(self._retries+1):
+                if self._metrics:
+                    self._metrics.local.endpoint = name
+                tic = time.perf_counter()
+                try:
+                    result = attr(*args, **kwargs)
+                    if self._metrics:
+                        self._metrics.record(name, time.perf_counter()-tic)
+                    return result
+                except Exception as e:
+                    if self._metrics:
+                        self._metrics.record(name, time.perf_counter()-tic, error=True)
+                    if attempt == self._retries or not self._retryable(name, e):
+                        raise
+                    delay = min(self._backoff_max, self._backoff * 2**attempt) * random.uniform(0.5, 1.5)
+                    print(f'{name} failed ({type(e).__name__}: {getattr(e, "status", e)}), retry {attempt+1}/{self._retries} in {delay:.1f}s')
+                    time.sleep(delay)
+        return call
+
+
+class ApiMetrics:
+    """ Per-endpoint call counts, errors, response bytes and latencies of ApiSession calls.
+        Each retry attempt counts as a call.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # endpoint of the call in progress on this thread, for byte counts
+        self.endpoints = defaultdict(lambda: dict(count=0, errors=0, bytes=0, latencies=[]))
+
+    def record(self, endpoint, seconds, error=False):
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['latencies'].append(seconds)
+
+    def record_bytes(self, nbytes):
+        with self.lock:
+            self.endpoints[getattr(self.local, 'endpoint', 'other')]['bytes'] += nbytes
+
+    def instrument(self, rest_client):
+        """ Counts response bytes of everything requested through a tator RESTClientObject """
+        rest_request = rest_client.request
+        @wraps(rest_request)
+        def request(*args, **kwargs):
+            response = rest_request(*args, **kwargs)
+            if isinstance(response, RESTResponse):
+                self.record_bytes(len(response.data or b''))
+            else:
+                self.record_bytes(int(response.getheader('Content-Length') or 0))
+            return response
+        rest_client.request = request
+
+    def summary(self):
+        def percentile(latencies, p):
+            return latencies[min(len(latencies)-1, int(p/100*len(latencies)))] if latencies else 0
+        endpoints = {}
+        for endpoint, stats in sorted(self.endpoints.items()):
+            latencies = sorted(stats['latencies'])
+            endpoints[endpoint] = dict(count=stats['count'], errors=stats['errors'], bytes=stats['bytes'],
+                                       total_s=sum(latencies), p50_s=percentile(latencies, 50),
+                                       p95_s=percentile(latencies, 95), p99_s=percentile(latencies, 99))
+        # the getters, and whatever else reads the disk cache (eg get_snapshot)
+        memory_hits = {getter.__name__:getter.cache_info().hits for getter in CACHED_GETTERS}
+        caches = {}
+        for name in sorted(set(memory_hits) | set(CACHE.stats)):
+            disk = CACHE.stats.get(name, dict(hits=0, misses=0))
+            caches[name] = dict(memory_hits=memory_hits.get(name, 0), disk_hits=disk['hits'], misses=disk['misses'])
+        return dict(endpoints=endpoints, caches=caches)
+
+    def report(self, outfile='-'):
+        """ Prints a table of the summary, or writes it as json to OUTFILE """
+        summary = self.summary()
+        if outfile != '-':
+            with open(outfile, 'w') as f:
+                json.dump(summary, f, indent=2)
+            return
+        print(f'\n{"ENDPOINT":<32} {"CALLS":>7} {"ERRORS":>6} {"MB":>9} {"TOTAL_S":>9} {"P50_MS":>8} {"P95_MS":>8} {"P99_MS":>8}')
+        for endpoint, st in summary['endpoints'].items():
+            print(f'{endpoint:<32} {st["count"]:>7} {st["errors"]:>6} {st["bytes"]/1e6:>9.2f} {st["total_s"]:>9.1f} '
+                  f'{st["p50_s"]*1000:>8.0f} {st["p95_s"]*1000:>8.0f} {st["p99_s"]*1000:>8.0f}')
+        print(f'\n{"CACHE":<32} {"MEMORY_HITS":>11} {"DISK_HITS":>9} {"MISSES":>7} {"HIT_RATE":>8}')
+        for getter, st in summary['caches'].items():
+            lookups = st['memory_hits'] + st['disk_hits'] + st['misses']
+            if lookups:
+                hit_rate = (st['memory_hits']+st['disk_hits'])/lookups
+                print(f'{getter:<32} {st["memory_hits"]:>11} {st["disk_hits"]:>9} {st["misses"]:>7} {hit_rate:>8.0%}')
+
+
+def get_api(host, token, workers=DEFAULT_WORKERS, retries=5, timeout=300, metrics=None, recorder=None):
+    """ tator.get_api with a keep-alive connection pool sized for WORKERS concurrent requests,
+        retries with backoff and a TIMEOUT seconds read timeout per request. All scripts should use this.
+        Calls are recorded to METRICS if an ApiMetrics is given, and HTTP exchanges to RECORDER
+        if an http_fixture.Recorder is given.
+    """
+    api = tator.get_api(host, token)
+    config = api.api_client.configuration
+    config.connection_pool_maxsize = max(workers, 1)
+    api.api_client.rest_client = RESTClientObject(config)  # urllib3 pools keep connections alive between requests
+    if recorder:
+        recorder.instrument(api.api_client.rest_client)
+    if metrics:
+        metrics.instrument(api.api_client.rest_client)
+    return ApiSession(api, retries=retries, timeout=(10, timeout), metrics=metrics)
+
+class ConcurrentError(Exception):
+    """ Raised by concurrent_map after all calls finished if any of them failed.
+        errors is a list of (index, item, exception), results has None at the failed indexes.
+    """
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        index, item, error = errors[0]
+        super().__init__(f'{len(errors)} of {len(results)} calls failed. First, item {index}: {type(error).__name__}: {error}')
+
+def paginate(api, func_name, page_size=1000, **kwargs):
+    """ Yields the pages of api.FUNC_NAME(**KWARGS), of at most PAGE_SIZE objects, paging by id with
+        after/start/stop. Unlike tator.util.get_paginator, an empty result or a last page that is
+        exactly full ends the pages rather than failing.
+    """
+    func = getattr(api, func_name)
+    after = None
+    while True:
+        page = func(after=after, start=0, stop=page_size, **kwargs)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = page[-1].id
+
+def concurrent_imap(func, items, workers=DEFAULT_WORKERS, window=None):
+    """ Calls func(item) for each item of an iterable from a pool of WORKERS threads, with at most
+        WINDOW (default 2*WORKERS) items submitted ahead of the consumer. Items are read lazily.
+        Yields (item, result, exception) tuples in item order; one of result/exception is None.
+    """
+    window = window or 2*workers
+    with ThreadPoolExecutor(workers) as pool:
+        futures = deque()
+        def pop():
+            item, future = futures.popleft()
+            try:
+                return item, future.result(), None
+            except Exception as e:
+                return item, None, e
+        for item in items:
+            futures.append((item, pool.submit(func, item)))
+            if len(futures) >= window:
+                yield pop()
+        while futures:
+            yield pop()
+
+def concurrent_map(func, items, workers=DEFAULT_WORKERS, desc=None):
+    """ Runs func(item) for every item with at most WORKERS calls in flight and returns the results
+        in item order. Failures don't stop the other calls; they are raised together as a ConcurrentError.
+        If DESC is given a progress bar is shown.
+    """
+    total = len(items) if hasattr(items, '__len__') else None
+    results, errors = [], []
+    for index, (item, result, error) in enumerate(tqdm(concurrent_imap(func, items, workers), total=total, desc=desc, disable=desc is None)):
+        results.append(result)
+        if error is not None:
+            errors.append((index, item, error))
+    if errors:
+        raise ConcurrentError(errors, results)
+    return results
+
+
+def add_api_args(parser):
+    group = parser.add_argument_group(title='API Connection')
+    group.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'Max concurrent API requests, also the connection pool size. Default is {DEFAULT_WORKERS}')
+    group.add_argument('--retries', type=int, default=5, help='Retries for transient API failures (429, 5xx, connection resets). Default is 5')
+    group.add_argument('--timeout', type=float, default=300, help='Per-request read timeout in seconds. Default is 300')
+    group.add_argument('--metrics', metavar='JSON', nargs='?', const='-', help='Report per-endpoint API call and cache statistics at exit. Printed as a table, or written to JSON if given')
+    group.add_argument('--record', metavar='FIXTURE', help='Record all API requests and responses to FIXTURE, for replay with http_fixture.py')
+    return group
+
+def parse_shard(value):
+    """ 'I/N' -> (I, N), the --shard argument type """
+    try:
+        shard = tuple(map(int, value.split('/')))
+    except ValueError:
+        shard = ()
+    if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+        raise argparse.ArgumentTypeError(f'expected I/N with 0 <= I < N, got "{value}"')
+    return shard
+
+def slurm_array_shard():
+    """ (I, N) of this slurm array task, or None outside of an array job """
+    if 'SLURM_ARRAY_TASK_ID' not in os.environ or 'SLURM_ARRAY_TASK_COUNT' not in os.environ:
+        return None
+    task_min = int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    return int(os.environ['SLURM_ARRAY_TASK_ID'])-task_min, int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+
+def add_shard_arg(parser, items='media whose id'):
+    parser.add_argument('--shard', metavar='I/N', type=parse_shard, default=slurm_array_shard(),
+        help=f'Only process {items} modulo N is I. Defaults to the slurm array task (SLURM_ARRAY_TASK_ID/SLURM_ARRAY_TASK_COUNT), if any')
+
+def in_shard(media_id, shard):
+    return shard is None or media_id % shard[1] == shard[0]
+
+def shard_path(path, shard):
+    """ PATH with SHARD inserted before its extension, eg locs.csv -> locs.shard3of8.csv """
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{shard[0]}of{shard[1]}{ext}'
+
+METRICS = None
+RECORDER = None
+
+def api_from_args(args, host=None, token=None):
+    """ get_api configured by the add_api_args options. With --metrics, every api made here
+        records to one ApiMetrics that is reported when the process exits.
+    """
+    global METRICS, RECORDER
+    if args.metrics and METRICS is None:
+        METRICS = ApiMetrics()
+        atexit.register(METRICS.report, args.metrics)
+    if args.record and RECORDER is None:
+        import http_fixture
+        RECORDER = http_fixture.Recorder(args.record)
+    return get_api(host or args.host, token or args.token, workers=args.workers, retries=args.retries,
+                   timeout=args.timeout, metrics=METRICS, recorder=RECORDER)
+
+class MetadataCache:
+    """ Persistent cache of tator metadata objects, keyed by host, entity and query.
+        Entries are json files at CACHE_DIR/<host>/<entity>/<key-hash>.json and expire after TTL seconds.
+        Objects are stored in their REST representation so no credentials end up on disk.
+    """
+    MISS = object()
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.codec = ApiClient()  # (de)serializes openapi models, never makes requests
+        self.stats = defaultdict(Counter)  # {getter name or get_snapshot: {'hits':int, 'misses':int}}
+
+    @staticmethod
+    def host_dir(host):
+        return re.sub(r'[^\w.-]+', '_', re.sub(r'^\w+://', '', str(host))).strip('_')
+
+    def path(self, host, entity, key):
+        key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, self.host_dir(host), entity, f'{key_hash}.json')
+
+    def get(self, host, entity, key):
+        if not self.ttl:
+            return self.MISS
+        path = self.path(host, entity, key)
+        try:
+            if time.time()-os.path.getmtime(path) > self.ttl:
+                return self.MISS
+            with open(path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return self.MISS
+        if record['key'] != repr(key):
+            return self.MISS
+
+        class Response: data = json.dumps(record['value'])
+        return self.codec.deserialize(Response, record['type'])
+
+    def put(self, host, entity, key, value):
+        if not self.ttl:
+            return
+        if isinstance(value, list):
+            value_type = f'list[{type(value[0]).__name__}]' if value else 'list[object]'
+        else:
+            value_type = type(value).__name__
+        record = dict(key=repr(key), type=value_type, value=self.codec.sanitize_for_serialization(value))
+        path = self.path(host, entity, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write-then-rename so concurrent readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError):
+            pass  # caching is best-effort
+
+    def invalidate(self, host=None, entity=None):
+        target = self.cache_dir
+        if host is not None:
+            target = os.path.join(target, self.host_dir(host))
+            if entity is not None:
+                target = os.path.join(target, entity)
+        shutil.rmtree(target, ignore_errors=True)
+
+CACHE = MetadataCache()
+
+
+def api_host(api):
+    return api.api_client.configuration.host
+
+def _cache_key_part(value):
+    if hasattr(value, 'id'):
+        return value.id
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value if isinstance(value, (int, float, bool, type(None))) else str(value)
+
+def disk_cached(entity):
+    """ Memoizes an api_util getter in CACHE. Use below @lru_cache. """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def make_key(api, *args, **kwargs):
+            bound = signature.bind(api, *args, **kwargs)
+            bound.apply_defaults()
+            return tuple((k, _cache_key_part(v)) for k, v in bound.arguments.items() if k != 'api')
+
+        @wraps(func)
+        def wrapper(api, *args, **kwargs):
+            key = make_key(api, *args, **kwargs)
+            host = api_host(api)
+            value = CACHE.get(host, entity, key)
+            if value is CACHE.MISS:
+                CACHE.stats[func.__name__]['misses'] += 1
+                value = func(api, *args, **kwargs)
+                CACHE.put(host, entity, key, value)
+            else:
+                CACHE.stats[func.__name__]['hits'] += 1
+            return value
+
+        def prime(api, *args, value, **kwargs):
+            """ Stores an already-fetched VALUE as the result of func(api, *args, **kwargs) """
+            CACHE.put(api_host(api), entity, make_key(api, *args, **kwargs), value)
+        def peek(api, *args, **kwargs):
+            """ Cached result of func(api, *args, **kwargs) or CACHE.MISS, without calling func """
+            return CACHE.get(api_host(api), entity, make_key(api, *args, **kwargs))
+        wrapper.prime = prime
+        wrapper.peek = peek
+        return wrapper
+    return decorator
+
+
+class ProjectSnapshot:
+    """ All types, versions, sections and leaf types of a project, fetched once and indexed by name and by id.
+        Registered snapshots (see use_snapshot) serve the matching api_util getters without any requests.
+    """
+    LIST_FUNCS = dict(loctype='get_localization_type_list', statetype='get_state_type_list',
+                      mediatype='get_media_type_list', version='get_version_list',
+                      section='get_section_list', leaftype='get_leaf_type_list')
+    MODELS = dict(loctype='LocalizationType', statetype='StateType', mediatype='MediaType',
+                  version='Version', section='Section', leaftype='LeafType')
+
+    def __init__(self, host, project, objects):
+        self.host = host
+        self.project = project
+        self.objects = {kind:[] for kind in self.LIST_FUNCS}
+        self.by_id = {kind:{} for kind in self.LIST_FUNCS}
+        self.by_name = {kind:defaultdict(list) for kind in self.LIST_FUNCS}
+        self.cached = set()  # kinds read from the metadata cache, refreshed once on a name miss
+        for kind, objs in objects.items():
+            for obj in objs:
+                self.add(kind, obj)
+
+    @classmethod
+    def fetch(cls, api, project):
+        """ Lists are read from the metadata cache when fresh, so only the first of many processes requests them """
+        project = get_project(api, project)
+        host = api_host(api)
+        objects = {kind:CACHE.get(host, 'snapshot', (project.id, kind)) for kind in cls.LIST_FUNCS}
+        missing = [kind for kind,objs in objects.items() if objs is CACHE.MISS]
+        CACHE.stats['get_snapshot']['hits'] += len(cls.LIST_FUNCS)-len(missing)
+        CACHE.stats['get_snapshot']['misses'] += len(missing)
+        if missing:
+            with ThreadPoolExecutor(len(missing)) as pool:
+                futures = {kind:pool.submit(getattr(api, cls.LIST_FUNCS[kind]), project.id) for kind in missing}
+                for kind,future in futures.items():
+                    objects[kind] = future.result()
+                    CACHE.put(host, 'snapshot', (project.id, kind), objects[kind])
+        snapshot = cls(host, project, objects)
+        snapshot.cached = set(cls.LIST_FUNCS) - set(missing)
+        return snapshot
+
+    def refresh(self, api, kind):
+        """ Refetches the KIND list, eg when a name is missing from a cached list """
+        self.objects[kind], self.by_id[kind], self.by_name[kind] = [], {}, defaultdict(list)
+        for obj in getattr(api, self.LIST_FUNCS[kind])(self.project.id):
+            self.add(kind, obj)
+        self.store(kind)
+        self.cached.discard(kind)
+
+    def store(self, kind):
+        CACHE.put(self.host, 'snapshot', (self.project.id, kind), self.objects[kind])
+
+    def add(self, kind, obj):
+        self.objects[kind].append(obj)
+        self.by_id[kind][obj.id] = obj
+        self.by_name[kind][obj.name].append(obj)
+
+    def find(self, kind, query):
+        """ Objects of KIND named QUERY, or all of them if QUERY is "list" """
+        if query == 'list':
+            return list(self.objects[kind])
+        return list(self.by_name[kind].get(query, []))
+
+    def save(self, path):
+        codec = CACHE.codec
+        data = dict(host=self.host, project=codec.sanitize_for_serialization(self.project),
+                    objects={kind:codec.sanitize_for_serialization(objs) for kind,objs in self.objects.items()})
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        def deserialize(value, model):
+            class Response: data = json.dumps(value)
+            return CACHE.codec.deserialize(Response, model)
+        objects = {kind:deserialize(objs, f'list[{cls.MODELS[kind]}]') for kind,objs in data['objects'].items()}
+        return cls(data['host'], deserialize(data['project'], 'Project'), objects)
+
+SNAPSHOTS = {}  # {(host, project_id): ProjectSnapshot}
+
+def use_snapshot(snapshot):
+    SNAPSHOTS[(MetadataCache.host_dir(snapshot.host), snapshot.project.id)] = snapshot
+    return snapshot
+
+for snapshot_file in filter(None, SNAPSHOT_FILES.split(':')):
+    use_snapshot(ProjectSnapshot.load(snapshot_file))
+
+def get_snapshot(api, project):
+    """ Returns the registered ProjectSnapshot for PROJECT, fetching and registering one if needed """
+    project_id = get_project_id(api, project)
+    snapshot = find_snapshot(api, project_id)
+    return snapshot or use_snapshot(ProjectSnapshot.fetch(api, project_id))
+
+def find_snapshot(api, project_id):
+    return SNAPSHOTS.get((MetadataCache.host_dir(api_host(api)), project_id))
+
+def _snapshot_get(api, kind, obj_id):
+    """ Object of KIND by id from any registered snapshot of this host, else None """
+    host = MetadataCache.host_dir(api_host(api))
+    for (snapshot_host, _), snapshot in SNAPSHOTS.items():
+        if snapshot_host == host and obj_id in snapshot.by_id[kind]:
+            return snapshot.by_id[kind][obj_id]
+
+def _find_by_name(api, kind, query, project_id):
+    """ Objects of KIND named QUERY in a project, or all of them if QUERY is "list" """
+    snapshot = find_snapshot(api, project_id)
+    if snapshot:
+        if query != 'list' and kind in snapshot.cached and not snapshot.find(kind, query):
+            snapshot.refresh(api, kind)
+        return snapshot.find(kind, query)
+    objs = getattr(api, ProjectSnapshot.LIST_FUNCS[kind])(project_id)
+    return objs if query=='list' else [obj for obj in objs if obj.name == query]
+
+
 def cli():
     parser = argparse.ArgumentParser()
     parser.add_argument('--token', '-t', help='A tator api token', required=True)
@@ -23,7 +535,10 @@ def cli():
     parser.add_argument('--statetype', '-s', help='Name or ID of the StateType. "list" will list all StateTypes for given project')
     parser.add_argument('--leaftype', '-f', help='Name or ID of the LeafType. "list" will list all LeafTypes for given project')
     parser.add_argument('--leaf', default='list', help='Name or ID of a Leaf. "list" (default) will list all Leaf objects for given LeafType')
-    
+    parser.add_argument('--save-snapshot', metavar='JSON', help='Save a ProjectSnapshot of PROJECT to file. Point TATOR_SNAPSHOT at it to serve lookups from it')
+    parser.add_argument('--clear-cache', action='store_true', help=f'Clear the on-disk metadata cache for HOST before any lookups. Cache location is "{CACHE_DIR}", set by TATOR_CACHE_DIR')
+    add_api_args(parser)
+
     args = parser.parse_args()
 
     if os.path.isfile(args.token):
@@ -50,6 +565,7 @@ def cli():
 def add_arg_ids(api,args):
     if 'project' in args and args.project != 'list':
         args.project_id = get_project_id(api,args.project)
+        get_snapshot(api, args.project_id)  # one concurrent fetch serves all the type/version lookups below
     if 'user' in args and args.user != 'list':
         args.user_id = get_user(api,args.user).id
     if 'media' in args and args.media != 'list':
@@ -63,7 +579,7 @@ def add_arg_ids(api,args):
     if 'version' in args and args.version != 'list':
         args.version_id = get_version(api,args.version,project=args.project_id).id
     if 'statetype' in args and args.statetype != 'list':
-        args.statetype_id = get_statetype(api, args.version, project=args.project_id).id
+        args.statetype_id = get_statetype(api, args.statetype, project=args.project_id).id
     if 'leaftype' in args and args.leaftype != 'list':
         args.leaftype_id = get_leaftype(api, args.leaftype, project=args.project_id).id
         if 'leaf' in args and args.leaf != 'list':
@@ -71,6 +587,7 @@ def add_arg_ids(api,args):
 
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('project')
 def get_project(api, query):
     if str(query).isdigit(): 
         query = int(query)
@@ -99,25 +616,25 @@ def get_project_id(api, p):
         return p
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('section')
 def get_section(api, query, project=None):
     #if isinstance(query, Media):
     #    return query
     if str(query).isdigit():
         query = int(query)
     if isinstance(query, int):
-        return api.get_section(query)
+        return _snapshot_get(api, 'section', query) or api.get_section(query)
     project_id = get_project_id(api, project)
 
+    section_objs = _find_by_name(api, 'section', query, project_id)
     if query=='list':
-        section_objs = api.get_section_list(project_id)
         return sorted(section_objs, key = lambda section: section.id)
 
-    section_objs = api.get_section_list(project, name=query)
-
     assert len(section_objs)==1, f'Duplicate Sections Found for "{query}": {[obj.id for obj in section_objs]}' if len(section_objs)>1 else f'Section Not Found: "{query}"'
     return section_objs[0]
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('media')
 def get_media(api, query, project=None):
     #if isinstance(query, Media):
     #    return query
@@ -157,39 +674,115 @@ def get_medias(api, queries:tuple, project=None):
     return [get_media(api,elem,project_id) for elem in queries]
 
 
+def resolve_media_ids(api, queries, project=None, page_size=1000, workers=DEFAULT_WORKERS):
+    """ Maps many media names and/or IDs to media IDs with as few requests as possible.
+        Returns a {query: media_id} dict that can be used directly with pandas Series.map.
+        IDs are confirmed with one paginated get_media_list_by_id. Names already in the metadata cache
+        cost nothing. The others are looked up individually (concurrently) if that takes no more requests
+        than paging through the project's whole media list, as counted by get_media_count, otherwise the
+        list is paged. Fetched media are also stored in the metadata cache for later get_media calls.
+    """
+    project_id = get_project_id(api, project)
+    queries = {q for q in queries if q is not None}
+    id_queries = {q:int(q) for q in queries if str(q).isdigit()}
+    name_queries = {str(q):q for q in queries if q not in id_queries}
+
+    media_by_id = {}
+    if id_queries:
+        media_id_query = tator.models.MediaIdQuery(ids=sorted(set(id_queries.values())))
+        for page in paginate(api, 'get_media_list_by_id', page_size, project=project_id, media_id_query=media_id_query):
+            media_by_id.update({m.id:m for m in page})
+        missing = sorted(set(id_queries.values())-set(media_by_id))
+        assert not missing, f'Media Not Found: {missing}'
+
+    media_by_name = {}
+    for name in name_queries:
+        m = get_media.peek(api, name, project_id)
+        if m is not CACHE.MISS:
+            media_by_name[name] = m
+    uncached = set(name_queries)-set(media_by_name)
+    listing_requests = api.get_media_count(project_id)//page_size + 1 if len(uncached) > 1 else 1
+    if len(uncached) <= listing_requests:
+        names = sorted(uncached)
+        media_by_name.update(zip(names, concurrent_map(lambda name: get_media(api, name, project_id), names, workers)))
+    else:
+        for page in paginate(api, 'get_media_list', page_size, project=project_id):
+            for m in page:
+                if m.name not in uncached:
+                    continue
+                assert m.name not in media_by_name, f'Duplicate Media Found for "{m.name}": {[media_by_name[m.name].id, m.id]}'
+                media_by_name[m.name] = m
+        missing = sorted(uncached-set(media_by_name))
+        assert not missing, f'Media Not Found: {missing}{"" if all("." in name for name in missing) else ". Did you remember to include a file extention like .mp4?"}'
+
+    for m in media_by_id.values():
+        get_media.prime(api, m.id, value=m)
+    for name, m in media_by_name.items():
+        get_media.prime(api, name, project_id, value=m)
+
+    mapping = {q:media_id for q,media_id in id_queries.items()}
+    mapping.update({q:media_by_name[name].id for name,q in name_queries.items()})
+    return mapping
+
+
+MEDIA_BY_ID = {}  # {(host, media_id): Media} for get_media_dict
+
+def get_media_dict(api, media_ids, project=None):
+    """ Returns {media_id: Media} for many media IDs. IDs not seen before in this process or in the
+        metadata cache are fetched together with one paginated get_media_list_by_id.
+    """
+    host = api_host(api)
+    missing = []
+    for media_id in set(media_ids):
+        if (host, media_id) in MEDIA_BY_ID:
+            continue
+        media = get_media.peek(api, media_id)
+        if media is CACHE.MISS:
+            missing.append(media_id)
+        else:
+            MEDIA_BY_ID[(host, media_id)] = media
+    if missing:
+        project_id = get_project_id(api, project)
+        media_id_query = tator.models.MediaIdQuery(ids=sorted(missing))
+        for page in paginate(api, 'get_media_list_by_id', project=project_id, media_id_query=media_id_query):
+            for media in page:
+                MEDIA_BY_ID[(host, media.id)] = media
+                get_media.prime(api, media.id, value=media)
+    return {media_id:MEDIA_BY_ID[(host, media_id)] for media_id in set(media_ids)}
+
+
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('mediatype')
 def get_mediatype(api, query, project=None):
     if str(query).isdigit():
         query = int(query)
     if isinstance(query, int):
-        return api.get_media_type(query)
+        return _snapshot_get(api, 'mediatype', query) or api.get_media_type(query)
     project_id = get_project_id(api, project)
 
-    mediatype_objs = api.get_media_type_list(project_id)
+    mediatype_obj = _find_by_name(api, 'mediatype', query, project_id)
 
     if query=='list':
-        return sorted(mediatype_objs, key = lambda p: p.id)
+        return sorted(mediatype_obj, key = lambda p: p.id)
 
-    mediatype_obj = [mt for mt in mediatype_objs if mt.name==query]
     assert len(mediatype_obj)==1, f'Duplicate MediaType Found for "{query}": {[obj.id for obj in mediatype_obj]}' if len(mediatype_obj)>1 else f'Media Not Found: "{query}"'
     return mediatype_obj[0]
 
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('version')
 def get_version(api, query, project=None, autocreate=False):
     #if isinstance(query,Version):
     #    return query
     if str(query).isdigit(): 
         query = int(query)
     if isinstance(query, int):
-        return api.get_version(query)
+        return _snapshot_get(api, 'version', query) or api.get_version(query)
     else:
         project_id = get_project_id(api, project)
-        version_objs = api.get_version_list(project_id)
+        version_objs = _find_by_name(api, 'version', query, project_id)
         if query=='list':
             return sorted(version_objs, key = lambda v: v.id)
-        
-        version_objs = [v for v in version_objs if v.name == query]
 
         if len(version_objs)==1:
             return version_objs[0]            
@@ -202,59 +795,64 @@ def get_version(api, query, project=None, autocreate=False):
                 new_version_spec['description'] = autocreate
             version_create_response = api.create_version(project_id, new_version_spec)
             print(version_create_response)  # TODO remove
-            return api.get_version(version_create_response.id)
+            version = api.get_version(version_create_response.id)
+            if find_snapshot(api, project_id):
+                find_snapshot(api, project_id).add('version', version)
+                find_snapshot(api, project_id).store('version')
+            return version
         else:
             raise KeyError(f'Version Not Found: "{query}"')
         
         
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('loctype')
 def get_loctype(api, query, project=None):
     #if isinstance(query, LocalizationType):
     #    return query
     if str(query).isdigit(): 
         query = int(query)
     if isinstance(query, int):
-        return api.get_localization_type(query)
+        return _snapshot_get(api, 'loctype', query) or api.get_localization_type(query)
     else:
 
         project_id = get_project_id(api, project)
 
-        loctype_objs = api.get_localization_type_list(project_id)
+        loctype_objs = _find_by_name(api, 'loctype', query, project_id)
         if query=='list':
             return loctype_objs
-        loctype_objs = [lt for lt in loctype_objs if lt.name == query]
         assert len(loctype_objs)==1, f'Duplicate Versions Found for "{query}": {[obj.id for obj in loctype_objs]}' if len(loctype_objs)>1 else f'LocalizationType Not Found: "{query}"'
         return loctype_objs[0]
 
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('statetype')
 def get_statetype(api, query, project=None):
     #if isinstance(query, StateType):
     #    return query
     if str(query).isdigit():
         query = int(query)
     if isinstance(query, int):
-        return api.get_state_type(query)
+        return _snapshot_get(api, 'statetype', query) or api.get_state_type(query)
     else:
 
         project_id = get_project_id(api, project)
 
-        statetype_objs = api.get_state_type_list(project_id)
+        statetype_objs = _find_by_name(api, 'statetype', query, project_id)
         if query=='list':
             return statetype_objs
-        statetype_objs = [st for st in statetype_objs if st.name == query]
         assert len(statetype_objs)==1, f'Duplicate Versions Found for "{query}": {[obj.id for obj in statetype_objs]}' if len(statetype_objs)>1 else f'LocalizationType Not Found: "{query}"'
         return statetype_objs[0]
 
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('user')
 def get_user(api, username_or_id):
     #if isinstance(username_or_id,User):
     #    return username_or_id
     if str(username_or_id).isdigit(): 
-        query = int(username_or_id)
+        username_or_id = int(username_or_id)
     if isinstance(username_or_id, int):
-        return api.get_user(query)
+        return api.get_user(username_or_id)
     elif username_or_id=='list':
         users = api.get_user_list()
         return sorted(users, key = lambda u: u.id)
@@ -263,25 +861,26 @@ def get_user(api, username_or_id):
 
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('leaftype')
 def get_leaftype(api, query, project=None):
     #if isinstance(query, LeafType):
     #    return query
     if str(query).isdigit():
         query = int(query)
     if isinstance(query, int):
-        return api.get_leaf_type(query)
+        return _snapshot_get(api, 'leaftype', query) or api.get_leaf_type(query)
     else:
 
         project_id = get_project_id(api, project)
 
-        leaftype_objs = api.get_leaf_type_list(project_id)
+        leaftype_objs = _find_by_name(api, 'leaftype', query, project_id)
         if query=='list':
             return leaftype_objs
-        leaftype_objs = [lt for lt in leaftype_objs if lt.name == query]
         assert len(leaftype_objs)==1, f'Duplicate Versions Found for "{query}": {[obj.id for obj in leaftype_objs]}' if len(leaftype_objs)>1 else f'LeafType Not Found: "{query}"'
         return leaftype_objs[0]
 
 @lru_cache(maxsize=None, typed=True)
+@disk_cached('leaf')
 def get_leaf(api, query, leaftype, project, att='path'):
     #if isinstance(query, Leaf):
     #    return query
@@ -307,6 +906,9 @@ def get_leaf(api, query, leaftype, project, att='path'):
             leaf_objs = [leaf for leaf in leaf_objs if query in getattr(leaf,att)]
             return leaf_objs
 
+CACHED_GETTERS = [get_project, get_section, get_media, get_mediatype, get_version,
+                  get_loctype, get_statetype, get_user, get_leaftype, get_leaf]
+
 def get_leaves(api, project, leaftype=None):
     if leaftype is None:
         leaftypes = get_leaftype(api, 'list', project)
@@ -316,7 +918,13 @@ def get_leaves(api, project, leaftype=None):
 
 if __name__=='__main__':
     args = cli()
-    api = tator.get_api(args.host, args.token)
+    api = api_from_args(args)
+    if args.clear_cache:
+        CACHE.invalidate(args.host)
+    if args.save_snapshot:
+        assert args.project and args.project != 'list', '--save-snapshot requires a single --project'
+        get_snapshot(api, args.project).save(args.save_snapshot)
+        print(f'SNAPSHOT SAVED: {args.save_snapshot}')
 
     if args.user:
         user = get_user(api, args.user)
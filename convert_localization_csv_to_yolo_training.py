@@ -4,23 +4,29 @@ import random
 from collections import defaultdict
 import shutil
 
-import pandas as pd
 import yaml
 
+import frame_cache
+import localization_io
+
 def cli():
     parser = argparse.ArgumentParser()
-    parser.add_argument('src', metavar='CSV')
+    parser.add_argument('src', metavar='CSV', help='Localizations .csv, .parquet or .feather file')
     parser.add_argument('outdir', metavar='YOLO_TRAINING_DIR')
     parser.add_argument('--classes', default='auto')
     parser.add_argument('--training-split', default=0.8, type=float)
     parser.add_argument('--clobber', action='store_true')
-    parser.add_argument('--imgiomode', default='symlink', choices=('symlink','copy','move'))
+    parser.add_argument('--imgiomode', default='symlink', choices=('symlink','hardlink','copy','move'))
+    parser.add_argument('--frame-cache', default=os.environ.get(frame_cache.ENV_VAR), help=f'Shared frame cache (see download_localizations.py) to take frames missing from IMAGEPATH from. With --imgiomode move, cached frames are copied. Default is ${frame_cache.ENV_VAR}')
+    parser.add_argument('--host', default='https://tator.whoi.edu', help='Tator host the frame cache entries were fetched from, default is "https://tator.whoi.edu"')
     parser.add_argument('--col_x', default='x')
     parser.add_argument('--col_y', default='y')
     parser.add_argument('--col_w', default='width')
     parser.add_argument('--col_h', default='height')
     parser.add_argument('--col_class', default='Class')
     parser.add_argument('--col_imagepath', default='imagepath')
+    parser.add_argument('--col_media', default='media_id', help='Media ID column, used with --frame-cache')
+    parser.add_argument('--col_frame', default='frame', help='Frame column, used with --frame-cache')
     parser.add_argument('--yamlfile', default='dataset.yaml')
     parser.add_argument('--imglistfile-train', default='train.txt')
     parser.add_argument('--imglistfile-val', default='val.txt')
@@ -69,9 +75,11 @@ def trainval_split(frames:list, training_ratio:float):
 def localization_csv_to_dicts(args):
     dtypes = {args.col_x: float, args.col_y: float,
               args.col_w: float, args.col_h: float}
-    df = pd.read_csv(args.src, dtype=dtypes)
     export_cols = [args.col_x, args.col_y, args.col_w, args.col_h,
                    args.col_class, args.col_imagepath]
+    if args.frame_cache:
+        export_cols += [args.col_media, args.col_frame]
+    df = localization_io.read_table(args.src, columns=export_cols, dtype=dtypes)
     dicts = list(df[export_cols].T.to_dict().values())
     return dicts
 
@@ -83,14 +91,21 @@ def localizations_to_yolo_training_directories(args, localizations):
     missing_tiffs = []
     locs_per_frame = defaultdict(list)
     csv_classes = set()
+    cache = frame_cache.FrameCache(args.frame_cache, args.host) if args.frame_cache else None
     for l in localizations:
         if not os.path.isfile(l[args.col_imagepath]):
-            missing_tiffs.append(l)
+            cached_frame = cache.lookup(l[args.col_media], l[args.col_frame]) if cache else None
+            if cached_frame:
+                l[args.col_imagepath] = cached_frame
+            else:
+                missing_tiffs.append(l)
         realpath = os.path.realpath(l[args.col_imagepath])
         locs_per_frame[realpath].append(l)
         csv_classes.add(l[args.col_class])
     error_str = "Can't find tiff frames:\n  " + '  \n'.join([l[args.col_imagepath] for l in missing_tiffs])
     assert not missing_tiffs, error_str
+    if cache:
+        cache.close()
 
     # 2 create outdir
     print(f'Setting up outdir: {args.outdir}')
@@ -110,16 +125,30 @@ def localizations_to_yolo_training_directories(args, localizations):
         args.classes = csv_classes
     # TODO else: check for incongruence
 
+    # frames in the shared cache are copied rather than moved, the cache index still lists them
+    cache_root = os.path.join(os.path.realpath(args.frame_cache), '') if args.frame_cache else None
     dst_frames = []
+    evicted_frames = []
     for realpath, localizations in locs_per_frame.items():
         frame_filename = os.path.basename(realpath)
         dst_frame = os.path.join(images_dir, frame_filename)
-        if args.imgiomode == 'copy':
-            shutil.copyfile(realpath, dst_frame)
-        elif args.imgiomode == 'move':
-            shutil.move(realpath, dst_frame)
-        else:
-            os.symlink(realpath, dst_frame)
+        in_cache = cache_root and realpath.startswith(cache_root)
+        try:
+            if args.imgiomode == 'copy' or (args.imgiomode == 'move' and in_cache):
+                shutil.copyfile(realpath, dst_frame)
+            elif args.imgiomode == 'move':
+                shutil.move(realpath, dst_frame)
+            elif args.imgiomode == 'hardlink':
+                os.link(realpath, dst_frame)
+            else:
+                os.symlink(realpath, dst_frame)
+        except FileNotFoundError:
+            if not in_cache:
+                raise
+            # evicted by another process since it was looked up
+            cache.discard(realpath)
+            evicted_frames.append(realpath)
+            continue
         dst_frames.append(dst_frame)
 
         # 4 create label files on outdir:/labels for localizations for all frames
@@ -135,6 +164,9 @@ def localizations_to_yolo_training_directories(args, localizations):
                 f.write(f"{class_idx} {center_x} {center_y} {l[args.col_w]} {l[args.col_h]}\n")
                 loccount_perclass_perframe[frame_filename][l[args.col_class]] += 1
 
+    if evicted_frames:
+        print(f'WARNING: {len(evicted_frames)} frames were evicted from the frame cache by another process and are left out:\n  ' + '\n  '.join(evicted_frames))
+
     # 5 split frames into train and val lists, create train.txt and val.txt respectively
     print('Distributing Frames to Training and Validation datasets')
     # TODO split frames PERCLASS somehow
@@ -164,7 +196,7 @@ def localizations_to_yolo_training_directories(args, localizations):
     for cls in args.classes:
         dct = classcounts[cls]
         dct['total'] = dct['train'] + dct['val']
-        dct['train_ratio'] = dct['train'] / dct['total']
+        dct['train_ratio'] = dct['train'] / dct['total'] if dct['total'] else 0  # eg its frames were evicted
         print(
             f"  {cls:>20}: TRAIN:VAL {dct['train']}:{dct['val']} ({dct['train_ratio']:.0%},{1 - dct['train_ratio']:.0%}) Total: {dct['total']}")
     print(
@@ -1,17 +1,15 @@
 import argparse
 import os
 
-import pandas as pd
-
-import tator
-from tator.openapi.tator_openapi.models import Localization
-
 import api_util
+import localization_io
+
+CLASS_CORRECTIONS = {'euphasid':'euphausid', 'salp':'salpa_aspera'}  # HACK renaming some classes
 
 
 def cli():
     parser = argparse.ArgumentParser()
-    parser.add_argument('src', metavar='CSV')
+    parser.add_argument('src', metavar='CSV', help='Localizations .csv, .parquet or .feather file')
     parser.add_argument('--token', required=True, help='A tator api token')
     parser.add_argument('--host', default='https://tator.whoi.edu',
         help='Tator Server URL, default is "https://tator.whoi.edu"')
@@ -42,7 +40,8 @@ def cli():
     # check classes
     parser.add_argument('--action', action='append')
 
-    parser.add_argument('--outfile', help='Output CSV')
+    parser.add_argument('--outfile', help='Output .csv, .parquet or .feather file')
+    api_util.add_api_args(parser)
 
     args = parser.parse_args()
 
@@ -77,10 +76,23 @@ def pixel_to_ratio(img_length):
 def ratio_to_pixel(img_length):
     return lambda ratio: round(ratio*img_length)
 
+def check_classes(api, project_id, classes_csv):
+    """ Asserts that every class of CLASSES_CSV, once corrected by CLASS_CORRECTIONS, is a leaf of the project.
+        Also prints those missing from the enum choices of the project's first localization type.
+    """
+    print('CHECK CLASSES')
+    classes_csv = {CLASS_CORRECTIONS.get(c,c) for c in classes_csv}
+    classes_tator = {leaf.name for leaf in api_util.get_leaves(api, project_id)}
+    classes_tator_enum = api_util.get_loctype(api, 'list', project_id)[0]
+    classes_tator_enum = set([a for a in classes_tator_enum.attribute_types if a.dtype=='enum'][0].choices)
+    print(f'MISSING FROM ENUM: {classes_csv-classes_tator_enum}')
+    print(f'MISSING FROM LEAFS: {classes_csv-classes_tator}')
+    assert classes_csv.issubset(classes_tator), f'Unrecognized csv classes: {classes_csv-classes_tator}'
+
 if __name__ == '__main__':
     args = cli()
 
-    df = pd.read_csv(args.src)
+    df = localization_io.read_table(args.src)
 
     # rename columns using args.col_rename
     if args.col_rename:
@@ -95,29 +107,16 @@ if __name__ == '__main__':
         df[col] = df[col].astype(dtype)
 
 
-    api = tator.get_api(args.host, args.token)
+    api = api_util.api_from_args(args)
     project = api_util.get_project(api, args.project)
     args.project = project.name
     args.project_id = project.id
 
     if 'check_classes' in args.action:
-
-        # HACK renaming some classes
-        idx_euph = df[df[args.col_class]=='euphasid'].index
-        df.loc[idx_euph,args.col_class] = 'euphausid'
-        idx_salp = df[df[args.col_class]=='salp'].index
-        df.loc[idx_salp,args.col_class] = 'salpa_aspera'
+        df[args.col_class] = df[args.col_class].astype(object).replace(CLASS_CORRECTIONS)
         #print(set(df[args.col_class]))
-        
-        print('CHECK CLASSES')
-        classes_csv = set(df[args.col_class])
-        classes_tator = {leaf.name for leaf in api_util.get_leaves(api, args.project_id)}
-        classes_tator_enum = api_util.get_loctype(api, 'list', args.project_id)[0]
-        classes_tator_enum = set([a for a in classes_tator_enum.attribute_types if a.dtype=='enum'][0].choices)
-        print(f'MISSING FROM ENUM: {classes_csv-classes_tator_enum}')
-        print(f'MISSING FROM LEAFS: {classes_csv-classes_tator}')
-        assert classes_csv.issubset(classes_tator), f'Unrecognized csv classes: {classes_csv-classes_tator}'
-        
+        check_classes(api, args.project_id, set(df[args.col_class]))
+
     if 'add_tiff_frame' in args.action:
         print('ADDING TIFF IMG PATHS')
         df[args.col_imagepath] = df.apply(lambda l: os.path.join(
@@ -141,6 +140,6 @@ if __name__ == '__main__':
         df[args.col_x] = df[args.col_x].clip(lower=0, upper=1)
         df[args.col_y] = df[args.col_y].clip(lower=0, upper=1)
 
-    if args.outfile and args.outfile.endswith('.csv'):
-        df.to_csv(args.outfile, index=False)
+    if args.outfile and args.outfile.endswith(('.csv',)+localization_io.COLUMNAR_EXTS):
+        localization_io.write_table(df, args.outfile)
 
@@ -4,14 +4,13 @@ from collections import defaultdict
 
 import argparse
 import pandas as pd
-import tator
 from tator.openapi.tator_openapi.models import Localization
 from tqdm import tqdm
 import shutil
 import api_util as util
 
 with open('sbatchelder.token') as f: TOKEN=f.read().strip()
-api = tator.get_api('https://tator.whoi.edu',TOKEN)
+api = util.get_api('https://tator.whoi.edu',TOKEN)
 project_id=1
 statetype_id=1
 version_id=2
@@ -1,14 +1,24 @@
-from pprint import pprint
 import os
+import sys
+import glob
+import re
+import json
+import base64
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
 
 import argparse
 import pandas as pd
 import tator
-from tator.openapi.tator_openapi.models import Localization
 from tqdm import tqdm
 import shutil
 import api_util
+import download_util
+import frame_cache
+import frame_source
+import localization_io
+import localization_store
 
 def cli():
     parser = argparse.ArgumentParser()
@@ -23,14 +33,34 @@ def cli():
     parser.add_argument('--att', metavar=('ATT', 'VAL'), nargs=2, action='append',
         help='Attribute Equality filter. May be invoked several times. Eg "--att Verified true --att Class diatom"')
     parser.add_argument('--pagination', metavar=('START', 'STOP'), nargs=2, type=int, help='limit returned results')
+    filters = parser.add_argument_group(title='Server-side Filters', description='Applied by the server, so only matching localizations are transferred. Eg "--att-gt ModelScore 0.8 --frame-range 0 5000"')
+    for op in ('lt', 'lte', 'gt', 'gte', 'contains'):
+        filters.add_argument(f'--att-{op}', metavar=('ATT', 'VAL'), nargs=2, action='append', help=f'Attribute {op} filter. May be invoked several times')
+    filters.add_argument('--frame-range', metavar=('START', 'STOP'), nargs=2, type=int, help='Localizations with START <= frame < STOP')
+    filters.add_argument('--modified-after', metavar='DATETIME', help='Localizations last modified at or after DATETIME (ISO 8601, eg 2023-06-01 or 2023-06-01T12:00:00+00:00)')
+    filters.add_argument('--modified-before', metavar='DATETIME', help='Localizations last modified before DATETIME')
+    filters.add_argument('--media-att', metavar=('ATT', 'VAL'), nargs=2, action='append', help='Media attribute equality filter, applied to the media of the localizations')
+    filters.add_argument('--search', metavar='SPEC', help='AttributeOperationSpec as json (or a json file), eg \'{"method":"or","operations":[{"attribute":"Class","operation":"eq","value":"diatom"},{"attribute":"Verified","operation":"eq","value":true}]}\'')
+    filters.add_argument('--media-search', metavar='SPEC', help='AttributeOperationSpec as json (or a json file), applied to the media of the localizations')
     parser.add_argument('--id', help='Either a single Localization ID or a text file listing multiple IDs')
     parser.add_argument('--statetype', help='StateType Name or ID to filter Localizations by frame. Cannot be used with FRAME, PAGINATION, or ID')
     parser.add_argument('--state-att', nargs=2, action='append', help='Further filter states by attribute equality')
     parser.add_argument('--chips-download-dir', help='Directory to download localization chips (thumbnails) to')
     parser.add_argument('--frame-download-dir', help='Directory to download frames to')
+    parser.add_argument('--video-dir', action='append', help='Directory of local media videos (eg tiff2video_output) to read frames from. May be invoked several times')
+    parser.add_argument('--api-frames', action='store_true', help='Always fetch frames from the api, even if the original TIFFs or a VIDEO_DIR video are available locally')
+    parser.add_argument('--frame-cache', default=os.environ.get(frame_cache.ENV_VAR), help=f'Shared frame cache directory. Frames are fetched into it once and linked from it. Default is ${frame_cache.ENV_VAR}')
+    parser.add_argument('--frame-cache-gb', type=float, help='Size bound of the frame cache, least recently used frames are evicted beyond it')
+    parser.add_argument('--api-chips', action='store_true', help='Fetch each chip from the api instead of cropping chips from frames')
+    parser.add_argument('--verify-downloads', action='store_true', help=f'Re-fetch images recorded in a download dir\'s {download_util.MANIFEST_NAME} that are missing or have changed size')
+    parser.add_argument('--page-size', type=int, default=1000, help='Localizations fetched per request. Default is 1000')
+    parser.add_argument('--sync', metavar='SQLITE', help='Keep the selection in a local store, only fetching localizations modified since the last run. The output is exported from the store. Cannot be used with STATETYPE, PAGINATION or ID')
+
+    parser.add_argument('--outfile', help='Output .csv, .parquet or .feather file. Parquet and Feather are written page by page with typed columns')
+    api_util.add_shard_arg(parser)
+    api_util.add_api_args(parser)
+    parser.epilog = 'Outputs of sharded runs (--shard) are combined with: download_localizations.py merge OUTFILE'
 
-    parser.add_argument('--outfile', help='Output CSV')
-    
     args = parser.parse_args()
 
     if os.path.isfile(args.token):
@@ -42,14 +72,80 @@ def cli():
             args.id = int(args.id)
         elif os.path.isfile(args.id):
             with open(args.id) as f:
-                args.id = map(int,f.read().splitlines())
+                args.id = list(map(int,f.read().splitlines()))
     
+    if args.shard:
+        assert not args.sync, '--sync cannot be used with --shard'
+        if args.outfile:
+            args.outfile = api_util.shard_path(args.outfile, args.shard)
+
     return args
 
 
-def get_localizations(api, project, versions=None, loctype=None, att_keyval_pairs=None, media=None, frame=None,
-                      startstop:tuple=None, id_list=None, section=None):
-    created_ids = []
+def server_filters(args):
+    """ get_localization_list keyword arguments for the Server-side Filters options """
+    kwargs = defaultdict(list)
+    for op in ('lt', 'lte', 'gt', 'gte', 'contains'):
+        kwargs[f'attribute_{op}'] += [f'{att}::{val}' for att,val in getattr(args, f'att_{op}') or []]
+    # built-in fields are addressed with a $ prefix
+    if args.frame_range:
+        kwargs['attribute_gte'].append(f'$frame::{args.frame_range[0]}')
+        kwargs['attribute_lt'].append(f'$frame::{args.frame_range[1]}')
+    if args.modified_after:
+        kwargs['attribute_gte'].append(f'{localization_store.MODIFIED_DATETIME}::{args.modified_after}')
+    if args.modified_before:
+        kwargs['attribute_lt'].append(f'{localization_store.MODIFIED_DATETIME}::{args.modified_before}')
+    kwargs['related_attribute'] += [f'{att}::{val}' for att,val in args.media_att or []]
+    kwargs = {key:val for key,val in kwargs.items() if val}
+    for arg, key in [('search', 'encoded_search'), ('media_search', 'encoded_related_search')]:
+        spec = getattr(args, arg)
+        if spec:
+            if os.path.isfile(spec):
+                with open(spec) as f:
+                    spec = f.read()
+            kwargs[key] = base64.b64encode(json.dumps(json.loads(spec)).encode()).decode()
+    return kwargs
+
+
+def merge_cli():
+    parser = argparse.ArgumentParser(prog='download_localizations.py merge',
+        description='Concatenates the outputs of a --shard I/N run, eg locs.shard0of8.csv ... locs.shard7of8.csv into locs.csv')
+    parser.add_argument('outfile', metavar='OUTFILE', help='The --outfile given to the shards')
+    return parser.parse_args(sys.argv[2:])
+
+
+def merge_shards(outfile):
+    """ Merges the shard outputs of OUTFILE into OUTFILE, checking that every shard is present """
+    root, ext = os.path.splitext(outfile)
+    shard_paths = {}
+    for path in glob.glob(glob.escape(root)+'.shard*of*'+ext):
+        match = re.fullmatch(re.escape(root)+r'\.shard(\d+)of(\d+)'+re.escape(ext), path)
+        if match:
+            shard_paths[int(match[1]), int(match[2])] = path
+    assert shard_paths, f'No shard outputs found for {outfile}'
+    shard_counts = {n for i,n in shard_paths}
+    assert len(shard_counts) == 1, f'Shard outputs of different shard counts found: {sorted(shard_paths.values())}'
+    n = shard_counts.pop()
+    missing = [f'{i}/{n}' for i in range(n) if (i,n) not in shard_paths]
+    assert not missing, f'Missing shard outputs: {missing}'
+    paths = [shard_paths[i,n] for i in range(n)]
+    print(f'Merging {n} shards into {outfile}')
+    localization_io.merge_tables(paths, outfile)
+
+
+def shard_media_ids(api, project, shard, media=None, section=None, page_size=1000):
+    """ Sorted ids of the media of PROJECT (or of SECTION, or just MEDIA) that belong to SHARD """
+    if media:
+        media_ids = [api_util.get_media_id(api, media, project)]
+    else:
+        kwargs = dict(section=api_util.get_section(api, section, project).id) if section else {}
+        media_ids = [m.id for page in api_util.paginate(api, 'get_media_list', page_size, project=project, **kwargs) for m in page]
+    return sorted(media_id for media_id in media_ids if api_util.in_shard(media_id, shard))
+
+
+def localization_query(api, project, versions=None, loctype=None, att_keyval_pairs=None, media=None, frame=None,
+                       section=None, media_ids=None, filters:dict=None):
+    """ get_localization_list keyword arguments selecting localizations. FILTERS are further keyword arguments, see server_filters """
     project = api_util.get_project(api,project)
 
     kwargs = {}
@@ -59,7 +155,9 @@ def get_localizations(api, project, versions=None, loctype=None, att_keyval_pair
     if loctype: 
         kwargs['type'] = api_util.get_loctype(api, loctype, project=project.id).id
     if media:
-        kwargs['media_id'] = [api_util.get_media(api, media).id]
+        kwargs['media_id'] = [api_util.get_media(api, media, project=project.id).id]
+    if media_ids:
+        kwargs['media_id'] = list(media_ids)
     if frame:  
         kwargs['frame'] = int(frame)
     if section:
@@ -70,9 +168,15 @@ def get_localizations(api, project, versions=None, loctype=None, att_keyval_pair
     # attribute (list[str**]) - Attribute equality filter. 
     #     _lt _lte _gt _gte _contains _null 
     #     Format is attribute1::value1,[attribute2::value2].
-    
-    # media_search (str) - lucene query for elasticsearch
-    # search (str) - lucene query for elasticsearch 
+    kwargs.update(filters or {})
+    return kwargs
+
+
+def iter_localizations(api, project, versions=None, loctype=None, att_keyval_pairs=None, media=None, frame=None,
+                       startstop:tuple=None, id_list=None, section=None, page_size=1000, media_ids=None, filters:dict=None):
+    """ Yields pages (lists) of at most PAGE_SIZE localizations, so that only one page is in memory at a time """
+    project = api_util.get_project(api,project)
+    kwargs = localization_query(api, project.id, versions, loctype, att_keyval_pairs, media, frame, section, media_ids, filters)
 
     if startstop:
         kwargs['start'] = int(startstop[0])
@@ -83,38 +187,144 @@ def get_localizations(api, project, versions=None, loctype=None, att_keyval_pair
     if id_list:
         if not isinstance(id_list,list): id_list = [id_list]
         id_list = list(map(int,id_list))
-        localization_id_query = tator.models.LocalizationIdQuery(ids=id_list)
-        localizations = api.get_localization_list_by_id(project.id, localization_id_query, **kwargs)
+        for idx in range(0, len(id_list), page_size):
+            localization_id_query = tator.models.LocalizationIdQuery(ids=id_list[idx:idx+page_size])
+            yield api.get_localization_list_by_id(project.id, localization_id_query, **kwargs)
+    elif startstop:
+        yield api.get_localization_list(project.id, **kwargs)
     else:
-        localizations = api.get_localization_list(project.id, **kwargs)
-
-    return localizations
-
-
-def format_localization_dict(api, l:Localization):
-    d = dict()
-    media_obj = api_util.get_media(api, l.media)
-    d['id'] = l.id
-    d['media_id'] = l.media
-    d['media'] = api_util.get_media(api, l.media).name
-    d['frame'] = l.frame
-    if 'tiff_dir' in media_obj.attributes and 'tiff_pattern' in media_obj.attributes:
-        d['frame_tiff'] = os.path.join(media_obj.attributes['tiff_dir'],media_obj.attributes['tiff_pattern'].format(l.frame))
-    d['version_id'] = l.version
-    d['version'] = api_util.get_version(api, l.version).name
-    #d['created_by'] = api.get_user(l.created_by).username if l.created_by else ''
-    #d['created_datetime'] = l.created_datetime.isoformat(timespec='seconds') if l.created_datetime else ''
-    d['modified_by'] = api.get_user(l.modified_by).username if l.modified_by else ''
-    d['modified_datetime'] = l.modified_datetime.isoformat(timespec='seconds') if l.modified_datetime else ''
+        yield from api_util.paginate(api, 'get_localization_list', page_size, project=project.id, **kwargs)
+
+
+def iter_state_frame_localizations(api, project, states, versions=None, loctype=None, att_keyval_pairs=None,
+                                   media_chunk_size=100, page_size=1000, workers=api_util.DEFAULT_WORKERS, filters:dict=None):
+    """ Yields pages of the localizations on the (media, frame) of each of STATES.
+        Localizations are queried for chunks of MEDIA_CHUNK_SIZE media at once and filtered to the
+        state frames locally, so requests scale with the number of media rather than frames.
+    """
+    frames_by_media = defaultdict(set)
+    for state in states:
+        frames_by_media[state.media[0]].add(state.frame)
+    media_ids = sorted(frames_by_media)
+    media_chunks = [media_ids[idx:idx+media_chunk_size] for idx in range(0, len(media_ids), media_chunk_size)]
+
+    def fetch_chunk(media_chunk):
+        return [l for page in iter_localizations(api, project, versions, loctype, att_keyval_pairs,
+                                                 page_size=page_size, media_ids=media_chunk, filters=filters)
+                  for l in page if l.frame in frames_by_media[l.media]]
+
+    for media_chunk, locs, error in api_util.concurrent_imap(fetch_chunk, tqdm(media_chunks, desc='Media Chunks'), workers):
+        if error is not None:
+            raise error
+        yield locs
+
+
+def get_localizations(api, project, *args, **kwargs):
+    """ All localizations of an iter_localizations query, as one list """
+    return [l for page in iter_localizations(api, project, *args, **kwargs) for l in page]
+
+
+def format_localization_page(api, project, page:list):
+    """ Builds the output DataFrame (indexed by id) for a page of Localizations column by column.
+        Media, versions and users are looked up once per distinct value, not per localization.
+    """
+    media_ids = pd.Series([l.media for l in page])
+    frames = pd.Series([l.frame for l in page])
+    version_ids = pd.Series([l.version for l in page])
+    user_ids = pd.Series([l.modified_by for l in page])
+
+    media = api_util.get_media_dict(api, media_ids.unique().tolist(), project)
+    versions = {v:api_util.get_version(api, int(v)).name for v in version_ids.dropna().unique()}
+    users = {u:api_util.get_user(api, int(u)).username for u in user_ids.dropna().unique()}
+
+    cols = dict(id=[l.id for l in page], media_id=media_ids, media=media_ids.map({m.id:m.name for m in media.values()}), frame=frames)
+    tiffs = {m.id:(m.attributes['tiff_dir'], m.attributes['tiff_pattern']) for m in media.values()
+             if 'tiff_dir' in m.attributes and 'tiff_pattern' in m.attributes}
+    if tiffs:
+        # only the pattern is formatted, the directory may contain braces
+        cols['frame_tiff'] = [os.path.join(tiffs[m][0], tiffs[m][1].format(f)) if m in tiffs else None for m,f in zip(media_ids, frames)]
+    cols['version_id'] = version_ids
+    cols['version'] = version_ids.map(versions)
+    #cols['created_by'] / cols['created_datetime'] can be added the same way as modified_*
+    cols['modified_by'] = user_ids.map(users).fillna('')
+    cols['modified_datetime'] = [l.modified_datetime.isoformat(timespec='seconds') if l.modified_datetime else '' for l in page]
     for att in 'x y width height'.split():
-        d[att] = getattr(l,att)
-    d.update(l.attributes)
-    return d
+        cols[att] = [getattr(l,att) for l in page]
+    df = pd.DataFrame(cols)
+    attributes = pd.DataFrame.from_records([l.attributes for l in page])
+    for col in [col for col in attributes if col in df]:
+        # like dict.update, an attribute overrides the column of the same name wherever it is set
+        df[col] = [l.attributes[col] if col in l.attributes else value for l,value in zip(page, df[col].tolist())]
+    df = pd.concat([df, attributes.drop(columns=[col for col in attributes if col in df])], axis=1)
+    return df.set_index('id')
+
+
+def download_frames(api, project, frame_targets:dict, frame_dir, video_dirs=None, api_frames=False,
+                    workers=api_util.DEFAULT_WORKERS, verify=False, cache:frame_cache.FrameCache=None, shard=None):
+    """ Downloads FRAME_TARGETS ({path: (media_id, frame)}) into FRAME_DIR.
+        Frames of media with a local copy (see frame_source) are read from it, a media at a time,
+        unless API_FRAMES. The others come from the api.
+        With a CACHE, frames are fetched into the cache (if not already there) and linked from it.
+        Each SHARD keeps its own manifest.
+    """
+    manifest = download_util.Manifest(frame_dir, api_util.shard_path(download_util.MANIFEST_NAME, shard))
+    if verify:
+        print(f'  {manifest.verify()} recorded frames missing or truncated')
+
+    def fetch_frames(targets, manifest):
+        local_media = {}
+        if not api_frames:
+            local_source = frame_source.LocalFrameSource(video_dirs)
+            media = api_util.get_media_dict(api, sorted({key[0] for key in targets.values()}), project)
+            local_media = {media_id:m for media_id,m in media.items() if local_source.locate(m)}
+        local_targets = {path:key for path,key in targets.items() if key[0] in local_media}
+        api_targets = {path:key for path,key in targets.items() if key[0] not in local_media}
+        if local_targets:
+            print(f'  {len(local_targets)} frames of {len(local_media)} media from local copies')
+            fetch_media_frames = lambda media_id, keys: (((media_id,frame),tmp_path) for frame,tmp_path in
+                                                         local_source.extract(local_media[media_id], [key[1] for key in keys]))
+            download_util.download_images(local_targets, workers=workers, desc='Local frames', manifest=manifest,
+                                          fetch_group=fetch_media_frames, group_by=lambda key: key[0])
+        if api_targets or not local_targets:
+            download_util.download_images(api_targets, lambda media_frame: api.get_frame(media_frame[0], frames=[media_frame[1]]),
+                                          workers, desc='Frames', manifest=manifest)
 
+    if cache is None:
+        fetch_frames(frame_targets, manifest)
+    else:
+        todo = {path:key for path,key in frame_targets.items() if path not in manifest}
+        cache_targets = {cache.frame_path(*key):key for key in todo.values()}
+        for cache_path in cache_targets:  # evicted by another process since the index was read
+            if cache_path in cache and not os.path.isfile(cache_path):
+                cache.discard(cache_path)
+        print(f'  Frame cache {cache.root}: {sum(path in cache for path in cache_targets)} of {len(cache_targets)} frames cached')
+        for attempt in range(2):
+            if any(path not in cache for path in cache_targets):
+                fetch_frames(cache_targets, cache)
+            evicted = {}
+            for path,key in todo.items():
+                entry = cache.link(*key, path)
+                if entry is None:  # evicted by another process after it was looked up
+                    evicted[path] = key
+                else:
+                    manifest.add(path, entry['size'], entry['sha1'])
+            todo = evicted
+            if not todo:
+                break
+            print(f'  {len(todo)} frames were evicted from the frame cache by another process, fetching them again')
+            cache_targets = {cache.frame_path(*key):key for key in todo.values()}
+        if todo:  # evicted again, fetched without the cache
+            fetch_frames(todo, manifest)
+        cache.close()
+    manifest.close()
 
 if __name__=='__main__':
+    if sys.argv[1:2] == ['merge']:
+        merge_shards(merge_cli().outfile)
+        sys.exit()
+
     args = cli()
-    api = tator.get_api(args.host,args.token)
+    api = api_util.api_from_args(args)
     versions = [args.version] if args.version else []
 
 
@@ -123,64 +333,129 @@ if __name__=='__main__':
         assert len(loctypes)==1, 'Multiple Localization Types Detected: {'+','.join([f'{lt.id}:{lt.name}' for lt in loctypes])+'}. Specify one with --loctype'
         args.loctype = loctypes[0].id
 
+    filters = server_filters(args)
     print('Fetching localizations...')
-    if args.statetype:
+    if args.sync:
+        assert not (args.statetype or args.pagination or args.id), '--sync cannot be used with --statetype, --pagination or --id'
+        project_id = api_util.get_project_id(api, args.project)
+        store = localization_store.LocalizationStore(args.sync)
+        query = localization_query(api, project_id, versions, args.loctype, args.att, args.media, args.frame, args.section,
+                                   filters=filters)
+        fetched, deleted = store.sync(api, project_id, query, lambda page: format_localization_page(api, project_id, page),
+                                      args.page_size, args.workers)
+        print(f'  Synced {args.sync}: {fetched} fetched, {deleted} deleted, {len(store)} total')
+
+    elif args.statetype:
         project_id = api_util.get_project_id(api, args.project)
-        version_ids = [api_util.get_version(api, args.version).id] if args.version else None
-        media_ids = [api_util.get_media(api, args.media).id] if args.media else None
+        version_ids = [api_util.get_version(api, args.version, project=project_id).id] if args.version else None
+        media_ids = [api_util.get_media(api, args.media, project=project_id).id] if args.media else None
         statetype = api_util.get_statetype(api, args.statetype, project=project_id)
-        eq_attribs = [f'{key}::{val}' for key,val in args.state_att]
+        eq_attribs = [f'{key}::{val}' for key,val in args.state_att or []]
         states = api.get_state_list(project_id, type=statetype.id, version=version_ids, media_id=media_ids, attribute=eq_attribs )
-        localizations = []
-        media_frame_dict = defaultdict(list)
-        for state in states:
-            media_frame_dict[state.media[0]].append(state.frame)
-        for media_id,frames in tqdm(media_frame_dict.items()):
-            for frame in tqdm(frames, leave=False):
-                locs = get_localizations(api, args.project, versions, args.loctype, args.att, media_id, frame)
-                localizations.extend(locs)
+        states = [state for state in states if api_util.in_shard(state.media[0], args.shard)]
+        print(f'  {len(states)} {statetype.name} states')
+        pages = iter_state_frame_localizations(api, project_id, states, versions, args.loctype, args.att,
+                                               page_size=args.page_size, workers=args.workers, filters=filters)
+
+    elif args.shard and not (args.pagination or args.id):
+        # the shard's media are queried in chunks, so each shard only fetches its own localizations
+        project_id = api_util.get_project_id(api, args.project)
+        media_ids = shard_media_ids(api, project_id, args.shard, args.media, args.section, args.page_size)
+        print(f'  Shard {args.shard[0]}/{args.shard[1]}: {len(media_ids)} media')
+        pages = (page for idx in range(0, len(media_ids), 100)
+                      for page in iter_localizations(api, project_id, versions, args.loctype, args.att, frame=args.frame,
+                                                     section=args.section, page_size=args.page_size, media_ids=media_ids[idx:idx+100],
+                                                     filters=filters))
 
     else:
-        localizations = get_localizations(api, args.project, versions, args.loctype, args.att, args.media, args.frame, args.pagination, args.id, args.section)
+        pages = iter_localizations(api, args.project, versions, args.loctype, args.att, args.media, args.frame, args.pagination, args.id, args.section, page_size=args.page_size, filters=filters)
+        if args.shard:
+            pages = ([l for l in page if api_util.in_shard(l.media, args.shard)] for page in pages)
 
     ## DISPLAY
-    print('Building CSV')
-    print('  Formatting Localization Records:')
-    loc_dicts = [format_localization_dict(api,loc) for loc in tqdm(localizations)]
-    print('  Constructing DataFrame...')
-    df = pd.DataFrame.from_records(loc_dicts, index='id')
-    if args.frame_download_dir:
-        df['imagepath'] = df.apply(lambda row: os.path.join(args.frame_download_dir,f'{row.media_id}_{row.frame}.png'), axis=1)
-    if args.outfile and args.outfile.endswith('.csv'):
-        print('Saving CSV to:', args.outfile)
-        df.to_csv(args.outfile, index=True)
+    # pages are formatted as they arrive, so only one page of Localization objects is held at a time
+    if args.sync:
+        page_dfs = store.iter_dataframes(args.page_size)
     else:
-        print(df.T)
-
+        page_dfs = (format_localization_page(api, args.project, page) for page in tqdm(pages, desc='Pages') if page)
     if args.frame_download_dir:
-        print('Downloading Frames to:', args.frame_download_dir)
-        os.makedirs(args.frame_download_dir, exist_ok=True)
+        page_dfs = (page_df.assign(imagepath=[os.path.join(args.frame_download_dir, f'{media_id}_{frame}.png')
+                                              for media_id,frame in zip(page_df.media_id, page_df.frame)])
+                    for page_df in page_dfs)
 
-        for l in tqdm(localizations):
-            target_img_name = f'{l.media}_{l.frame}.png'
-            target_img_path = os.path.join(args.frame_download_dir,target_img_name)
-            if not os.path.isfile(target_img_path):  # todo clobber? but then what about keeping track of repeat frames
-                tmp_img_path = api.get_frame(l.media, frames=[l.frame])
-                shutil.copyfile(tmp_img_path,target_img_path)
+    download_cols = ['media_id', 'frame', 'x', 'y', 'width', 'height', 'Class', 'ClassStrCorrection']
+    if args.outfile and args.outfile.endswith(('.csv',)+localization_io.COLUMNAR_EXTS):
+        # each page is appended to the outfile as it arrives, with the columns of the localization type,
+        # so memory doesn't grow with the number of localizations. Only the columns needed for downloads are kept.
+        print('Writing', args.outfile)
+        loctype = api_util.get_loctype(api, args.loctype, args.project)
+        columns = localization_io.localization_columns(loctype, imagepath=bool(args.frame_download_dir))
+        keep_download_cols = args.frame_download_dir or args.chips_download_dir
+        page_dfs_kept = []
+        count = 0
+        with localization_io.open_writer(args.outfile, columns) as writer:
+            for page_df in page_dfs:
+                writer.write(page_df)
+                count += len(page_df)
+                if keep_download_cols:
+                    page_dfs_kept.append(page_df[[col for col in download_cols if col in page_df]])
+        if not count and args.shard:
+            print('No Localizations in this shard')
+            sys.exit()
+        assert count, 'No Localizations Found'
+        print(f'  {count} localizations in {writer.pages} pages')
+        df = pd.concat(page_dfs_kept) if keep_download_cols else None
+    else:
+        page_dfs = list(page_dfs)
+        if not page_dfs and args.shard:
+            print('No Localizations in this shard')
+            sys.exit()
+        assert page_dfs, 'No Localizations Found'
+        df = pd.concat(page_dfs)
+        del page_dfs
+        print(df.T)
 
+    # chips are cropped from frames, so frames are needed even if only chips were asked for
+    chip_targets = {}
     if args.chips_download_dir:
-        print('Downloading localization images to:', args.chips_download_dir)
+        classdirs = df['ClassStrCorrection'].where(df['ClassStrCorrection'].fillna('') != '', df['Class']) \
+                    if 'ClassStrCorrection' in df else df['Class']
+        chip_targets = {os.path.join(args.chips_download_dir, f'{classdir}/{media_id:04}_{frame:06}_{loc_id}.png'):(loc_id,media_id,frame,x,y,w,h)
+                        for loc_id,media_id,frame,x,y,w,h,classdir in zip(df.index, df.media_id, df.frame, df.x, df.y, df.width, df.height, classdirs)}
         os.makedirs(args.chips_download_dir, exist_ok=True)
-        for l in tqdm(localizations):
-            classdir = l.attributes["ClassStrCorrection"] or l.attributes["Class"]
-            target_img_name = f'{classdir}/{l.media:04}_{l.frame:06}_{l.id}.png'
-            target_img_path = os.path.join(args.chips_download_dir, target_img_name)
-            os.makedirs(os.path.dirname(target_img_path), exist_ok=True)
-            if not os.path.isfile(target_img_path):  # todo clobber?
-                tmp_img_path = api.get_localization_graphic(l.id)
-                shutil.copyfile(tmp_img_path, target_img_path)
-
-
-
+        chip_manifest = download_util.Manifest(args.chips_download_dir, api_util.shard_path(download_util.MANIFEST_NAME, args.shard))
+        if args.verify_downloads:
+            print(f'  {chip_manifest.verify()} recorded chips missing or truncated')
+    # chips already on disk (eg from a run without a manifest) are adopted rather than cropped again
+    pending_chips = download_util.adopt_existing(chip_manifest, chip_targets) if chip_targets else []
+    chips_pending = not args.api_chips and bool(pending_chips)
+    frame_dir = args.frame_download_dir or (tempfile.mkdtemp(prefix='chip_frames_') if chips_pending else None)
 
+    if frame_dir:
+        print('Downloading Frames to:', frame_dir)
+        if args.frame_download_dir:
+            # one target per distinct frame, however many localizations are on it
+            frame_keys = set(zip(df.media_id, df.frame))
+        else:
+            frame_keys = {chip_targets[path][1:3] for path in pending_chips}
+        frame_targets = {os.path.join(frame_dir, f'{media_id}_{frame}.png'):(media_id,frame) for media_id,frame in frame_keys}
+        cache = frame_cache.FrameCache(args.frame_cache, api_util.api_host(api), args.frame_cache_gb) if args.frame_cache else None
+        download_frames(api, args.project, frame_targets, frame_dir, args.video_dir, args.api_frames, args.workers,
+                        args.verify_downloads, cache, args.shard)
 
+    if args.chips_download_dir:
+        print('Downloading localization images to:', args.chips_download_dir)
+        if args.api_chips:
+            download_util.download_images(chip_targets, lambda key: api.get_localization_graphic(key[0]), args.workers,
+                                          desc='Chips', manifest=chip_manifest)
+        else:
+            # threads hand each frame's boxes to a process pool, which crops them from the frame in one go
+            with ProcessPoolExecutor(args.workers) as pool:
+                def crop_frame_chips(media_frame, keys):
+                    frame_path = os.path.join(frame_dir, f'{media_frame[0]}_{media_frame[1]}.png')
+                    return zip(keys, pool.submit(frame_source.crop_chips, frame_path, [key[3:] for key in keys]).result())
+                download_util.download_images(chip_targets, workers=args.workers, desc='Chips', manifest=chip_manifest,
+                                              fetch_group=crop_frame_chips, group_by=lambda key: key[1:3])
+            if frame_dir and not args.frame_download_dir:
+                shutil.rmtree(frame_dir)
+        chip_manifest.close()
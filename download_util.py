@@ -0,0 +1,171 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import threading
+from collections import defaultdict
+from time import perf_counter as tictoc
+
+import api_util
+
+MANIFEST_NAME = '.download_manifest.jsonl'
+IMAGE_TRAILERS = {'.png':b'IEND\xaeB`\x82', '.jpg':b'\xff\xd9', '.jpeg':b'\xff\xd9'}
+
+
+def atomic_move(src, dst):
+    """ Moves SRC to DST such that DST is either absent or complete, never partially written """
+    tmp_dst = f'{dst}.part{os.getpid()}'
+    shutil.move(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def file_digest(path):
+    """ Returns (size, sha1 hexdigest) of the file at PATH """
+    sha1 = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha1.update(chunk)
+            size += len(chunk)
+    return size, sha1.hexdigest()
+
+
+def image_complete(path):
+    """ True if the PNG or JPEG file at PATH ends with its format's trailer, ie was not truncated.
+        Other file types only need to be non-empty.
+    """
+    trailer = IMAGE_TRAILERS.get(os.path.splitext(path)[1].lower(), b'')
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < max(len(trailer), 1):
+            return False
+        f.seek(-len(trailer), os.SEEK_END)
+        return f.read() == trailer
+
+
+class Manifest:
+    """ Append-only record of the downloads completed under a directory, one json line per file
+        with its path (relative to the directory), size and sha1. Lines are flushed as downloads
+        complete, so an interrupted run loses nothing it finished.
+        Sibling manifests (eg .download_manifest.shard3of8.jsonl, written by other shards) are read too.
+    """
+    def __init__(self, root, name=MANIFEST_NAME):
+        self.root = root
+        self.path = os.path.join(root, name)
+        self.entries = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        partial_line = False
+        stem, ext = os.path.splitext(name)
+        stem = stem.split('.shard')[0]
+        for path in sorted(glob.glob(os.path.join(glob.escape(root), f'{stem}*{ext}'))):
+            with open(path) as f:
+                line = ''
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # last line of an interrupted run
+                        continue
+                    self.entries[entry['path']] = entry
+            if path == self.path:
+                partial_line = bool(line) and not line.endswith('\n')
+        self.file = open(self.path, 'a')
+        if partial_line:
+            self.file.write('\n')
+
+    def key(self, path):
+        prefix = os.path.join(self.root, '')
+        return path[len(prefix):] if path.startswith(prefix) else os.path.relpath(path, self.root)
+
+    def __contains__(self, path):
+        return self.key(path) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, path, size, sha1):
+        entry = dict(path=self.key(path), size=size, sha1=sha1)
+        with self.lock:
+            self.entries[entry['path']] = entry
+            self.file.write(json.dumps(entry)+'\n')
+            self.file.flush()
+
+    def verify(self):
+        """ Forgets entries whose file is missing or no longer has the recorded size. Returns how many were forgotten. """
+        stale = [key for key,entry in self.entries.items()
+                 if not os.path.isfile(os.path.join(self.root, key)) or os.path.getsize(os.path.join(self.root, key)) != entry['size']]
+        with self.lock:
+            for key in stale:
+                del self.entries[key]
+        return len(stale)
+
+    def close(self):
+        self.file.close()
+
+
+def adopt_existing(manifest:Manifest, paths):
+    """ Records in MANIFEST the complete images among PATHS that are on disk but not in it, eg from runs
+        without a manifest. Returns the paths still missing, in order.
+    """
+    todo = [path for path in paths if path not in manifest]
+    # one listing per directory rather than one stat per path
+    listings = {}
+    for dirname in {os.path.dirname(path) for path in todo}:
+        listings[dirname] = set(os.listdir(dirname)) if os.path.isdir(dirname) else set()
+    missing = []
+    for path in todo:
+        if os.path.basename(path) in listings[os.path.dirname(path)] and image_complete(path):
+            manifest.add(path, *file_digest(path))
+        else:
+            missing.append(path)
+    return missing
+
+
+def download_images(targets:dict, fetch=None, workers=api_util.DEFAULT_WORKERS, desc=None, manifest:Manifest=None,
+                    fetch_group=None, group_by=None):
+    """ Downloads images concurrently.
+        TARGETS maps destination paths to keys, eg {'frames/12_345.png': (12,345)}. Being a dict, every
+        destination is fetched at most once.
+        FETCH(key) must return the path of a temporary file holding the image, like api.get_frame does.
+        Files are moved into place atomically. Returns the number of images downloaded.
+        With a MANIFEST, completed downloads are recorded in it and skipped on later runs without touching
+        the filesystem. Files on disk that the manifest doesn't know about (eg from runs without one) are
+        kept if they are complete images and re-fetched otherwise.
+        Without a manifest, paths that already exist are skipped.
+        Instead of FETCH, FETCH_GROUP(group, keys) may fetch all the keys of a group at once (eg all the frames
+        of one media), yielding (key, temporary path) pairs. GROUP_BY(key) gives the group of a key.
+        Groups are fetched concurrently.
+    """
+    if manifest is None:
+        todo = {path:key for path,key in targets.items() if not os.path.isfile(path)}
+    else:
+        missing = set(adopt_existing(manifest, targets))
+        todo = {path:key for path,key in targets.items() if path in missing}
+    for dirname in {os.path.dirname(path) for path in todo}:
+        os.makedirs(dirname or '.', exist_ok=True)
+
+    def place(path, tmp_path):
+        if manifest is not None:
+            size, sha1 = file_digest(tmp_path)
+        atomic_move(tmp_path, path)
+        if manifest is not None:
+            manifest.add(path, size, sha1)
+
+    tic = tictoc()
+    if fetch_group is None:
+        api_util.concurrent_map(lambda path: place(path, fetch(todo[path])), list(todo), workers, desc=desc)
+    else:
+        groups = defaultdict(dict)
+        for path,key in todo.items():
+            groups[group_by(key)][key] = path
+        def download_group(group):
+            for key,tmp_path in fetch_group(group, list(groups[group])):
+                place(groups[group][key], tmp_path)
+        api_util.concurrent_map(download_group, list(groups), workers, desc=desc)
+    elapsed = tictoc()-tic
+    if todo:
+        print(f'Downloaded {len(todo)} images in {elapsed:.1f}s ({len(todo)/elapsed:.1f} images/s), {len(targets)-len(todo)} already present')
+    else:
+        print(f'All {len(targets)} images already present')
+    return len(todo)
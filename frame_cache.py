@@ -0,0 +1,138 @@
+""" A frame cache shared across runs and projects, eg on the HPC filesystem.
+
+Frames are stored at ROOT/<host>/<media id>/<media id>_<frame>.png. ROOT/index.jsonl records, for each cached frame,
+its size, sha1 and last use, one json line per insert or use, so the newest line for a frame wins.
+Inserts are atomic (see download_util.atomic_move) and index appends are serialized with a lock file, so
+several processes may share the cache. The index is compacted as each run closes the cache, and once the cache
+exceeds its size bound the least recently used frames are evicted.
+"""
+
+import os
+import json
+import time
+import fcntl
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import download_util
+
+ENV_VAR = 'TATOR_FRAME_CACHE'
+
+
+class FrameCache(download_util.Manifest):
+    """ Acts as the download manifest of its own directory, so download_util.download_images can fill it """
+    def __init__(self, root, host, max_gb=None):
+        self.host_dir = urlsplit(host).netloc or host.strip('/').replace('/','_')
+        self.max_bytes = max_gb*1e9 if max_gb else None
+        self.used = set()
+        os.makedirs(root, exist_ok=True)
+        self.lock_path = os.path.join(root, 'index.lock')
+        with self.locked():
+            super().__init__(root, name='index.jsonl')
+        self.file.close()  # appends reopen the index, which compaction may replace
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def frame_path(self, media_id, frame):
+        # named like download_localizations frames, so basenames stay unique when symlinks are resolved
+        return os.path.join(self.root, self.host_dir, str(media_id), f'{media_id}_{frame}.png')
+
+    def append(self, entries):
+        with self.locked(), open(self.path, 'a') as f:
+            f.writelines(json.dumps(entry)+'\n' for entry in entries)
+
+    def add(self, path, size, sha1):
+        entry = dict(path=self.key(path), size=size, sha1=sha1, atime=time.time())
+        with self.lock:
+            self.entries[entry['path']] = entry
+            self.used.add(entry['path'])
+        self.append([entry])
+
+    def lookup(self, media_id, frame):
+        """ Returns the path of the cached frame, or None if it isn't cached """
+        path = self.frame_path(media_id, frame)
+        if path not in self or not os.path.isfile(path):
+            return None
+        with self.lock:
+            self.used.add(self.key(path))
+        return path
+
+    def link(self, media_id, frame, dst):
+        """ Hardlinks the cached frame to DST, or symlinks it if DST is on another filesystem.
+            Returns the manifest entry of the cached frame, or None if another process evicted it
+            since the index was read, in which case its entry is dropped.
+        """
+        src = self.frame_path(media_id, frame)
+        tmp_dst = f'{dst}.part{os.getpid()}'
+        try:
+            os.link(src, tmp_dst)
+        except FileNotFoundError:
+            self.discard(src)
+            return None
+        except OSError:
+            if not os.path.isfile(src):
+                self.discard(src)
+                return None
+            os.symlink(os.path.abspath(src), tmp_dst)
+        os.replace(tmp_dst, dst)
+        key = self.key(src)
+        with self.lock:
+            self.used.add(key)
+        return self.entries[key]
+
+    def discard(self, path):
+        """ Forgets the cached frame at PATH, eg one evicted by another process """
+        key = self.key(path)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.used.discard(key)
+
+    def close(self):
+        """ Records the use of the frames used by this run and compacts the index,
+            evicting least recently used frames if the cache is over its size bound
+        """
+        now = time.time()
+        self.compact({key:dict(self.entries[key], atime=now) for key in self.used})
+
+    def compact(self, used=None):
+        """ Rewrites the index with one line per frame, updated with the USED entries. Then, if the cache is over
+            its size bound, deletes least recently used frames (other than those used by this run) until it fits.
+        """
+        with self.locked():
+            entries = {}
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries[entry['path']] = entry
+            entries.update(used or {})
+            total = sum(entry['size'] for entry in entries.values())
+            evicted = 0
+            for entry in sorted(entries.values(), key=lambda entry: entry['atime']):
+                if not self.max_bytes or total <= self.max_bytes:
+                    break
+                if entry['path'] in self.used:
+                    continue
+                try:
+                    os.remove(os.path.join(self.root, entry['path']))
+                except FileNotFoundError:
+                    pass
+                del entries[entry['path']]
+                total -= entry['size']
+                evicted += 1
+            tmp_path = f'{self.path}.part{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                f.writelines(json.dumps(entry)+'\n' for entry in entries.values())
+            os.replace(tmp_path, self.path)
+        if evicted:
+            print(f'Evicted {evicted} frames from {self.root}, {total/1e9:.1f} GB remain')
+        self.entries = entries
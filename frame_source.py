@@ -0,0 +1,126 @@
+""" Media frames read from local copies of the media rather than fetched one at a time with api.get_frame.
+
+A media's frames are read from its original TIFF directory (the tiff_dir and tiff_pattern media attributes)
+if that directory exists, else from a video named like the media in one of the given video directories
+(eg tiff2video_output). Videos are decoded by ffmpeg once per media, in a single sequential pass.
+crop_chips cuts localization chips out of a frame once it is on disk.
+"""
+
+import os
+import shutil
+import itertools
+import tempfile
+import subprocess
+
+from PIL import Image
+
+
+class LocalFrameSource:
+    def __init__(self, video_dirs=(), tiffs=True):
+        self.video_dirs = video_dirs or ()
+        self.tiffs = tiffs
+        self.ffmpeg = shutil.which('ffmpeg')
+        if self.video_dirs and not self.ffmpeg:
+            print('ffmpeg not found, local videos will not be used')
+
+    def locate(self, media):
+        """ Returns ('tiff', path pattern) or ('video', path) for MEDIA, or None if there is no local copy """
+        attributes = media.attributes or {}
+        if self.tiffs and 'tiff_dir' in attributes and 'tiff_pattern' in attributes and os.path.isdir(attributes['tiff_dir']):
+            return 'tiff', os.path.join(attributes['tiff_dir'], attributes['tiff_pattern'])
+        if self.ffmpeg:
+            names = [media.name, os.path.splitext(media.name)[0]+'.mp4']
+            for video_dir in self.video_dirs:
+                for name in names:
+                    if os.path.isfile(os.path.join(video_dir, name)):
+                        return 'video', os.path.join(video_dir, name)
+        return None
+
+    def extract(self, media, frames):
+        """ Yields (frame, path of a temporary PNG) for each of FRAMES of MEDIA, in frame order """
+        kind, path = self.locate(media)
+        frames = sorted(set(frames))
+        if kind == 'tiff':
+            for frame in frames:
+                fd, tmp_path = tempfile.mkstemp(suffix='.png')
+                os.close(fd)
+                with Image.open(path.format(frame)) as img:
+                    img.save(tmp_path)
+                yield frame, tmp_path
+        else:
+            yield from extract_video_frames(self.ffmpeg, path, frames)
+
+
+def extract_video_frames(ffmpeg, video, frames):
+    """ Decodes VIDEO once with ffmpeg, keeping only FRAMES (sorted, 0-based), and yields (frame, path of a temporary PNG).
+        Frames are streamed through a pipe and picked by counting them, so each one is yielded as soon as it is decoded.
+        Decoding stops after the last requested frame.
+    """
+    wanted = set(frames)
+    cmd = [ffmpeg, '-nostdin', '-loglevel', 'error', '-i', video, '-vsync', '0', '-frames:v', str(frames[-1]+1),
+           '-f', 'image2pipe', '-c:v', 'ppm', '-pix_fmt', 'rgb24', '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        for frame, size, pixels in read_ppm_stream(proc.stdout):
+            if frame in wanted:
+                fd, tmp_path = tempfile.mkstemp(suffix='.png')
+                os.close(fd)
+                Image.frombytes('RGB', size, pixels).save(tmp_path)
+                wanted.discard(frame)
+                yield frame, tmp_path
+            if not wanted:
+                break
+        else:
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+        assert not wanted, f'{video} has no frames {sorted(wanted)}'
+    finally:
+        proc.kill()
+        proc.stdout.close()
+        proc.wait()
+
+
+def read_ppm_stream(stream):
+    """ Yields (index, (width, height), RGB bytes) for each binary PPM image in STREAM, as written by ffmpeg -c:v ppm """
+    for idx in itertools.count():
+        header = []
+        while len(header) < 4:  # magic, width, height, maxval
+            token = b''
+            while True:
+                char = stream.read(1)
+                if not char:
+                    if header or token:
+                        raise EOFError('Truncated PPM stream')
+                    return
+                if char.isspace():
+                    if token:
+                        break
+                    continue
+                token += char
+            header.append(token)
+        assert header[0] == b'P6' and header[3] == b'255', f'Unexpected PPM header {header}'
+        size = int(header[1]), int(header[2])
+        pixels = stream.read(size[0]*size[1]*3)
+        if len(pixels) < size[0]*size[1]*3:
+            raise EOFError('Truncated PPM stream')
+        yield idx, size, pixels
+
+
+def crop_chips(frame_path, boxes):
+    """ Crops normalized (x, y, width, height) BOXES out of the image at FRAME_PATH, which is decoded once.
+        Returns the path of a temporary PNG per box. Runs in worker processes, so takes and returns only paths.
+    """
+    chip_paths = []
+    with Image.open(frame_path) as img:
+        img.load()
+        img_w, img_h = img.size
+        for x,y,w,h in boxes:
+            left = min(max(round(x*img_w), 0), img_w-1)
+            top = min(max(round(y*img_h), 0), img_h-1)
+            right = max(min(round((x+w)*img_w), img_w), left+1)
+            bottom = max(min(round((y+h)*img_h), img_h), top+1)
+            fd, chip_path = tempfile.mkstemp(suffix='.png')
+            os.close(fd)
+            img.crop((left, top, right, bottom)).save(chip_path)
+            chip_paths.append(chip_path)
+    return chip_paths
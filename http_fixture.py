@@ -0,0 +1,161 @@
+""" Record and replay the HTTP exchanges of a tator script, for offline and reproducible benchmarks.
+
+Recording: run any script with --record FIXTURE (see api_util.add_api_args), eg
+    python download_localizations.py --token TOKEN -p1 -v2 --outfile locs.csv --record locs.fixture.jsonl
+
+Replaying: serve the fixture locally, optionally with injected latency and bandwidth limits,
+and point the same command at it with --host
+    python http_fixture.py locs.fixture.jsonl --port 8080 --latency 0.08 --bandwidth 5
+    python download_localizations.py --host http://localhost:8080 --token x -p1 -v2 --outfile locs.csv
+
+Only requests made through the tator api client are captured. Request headers (and so tokens)
+are never recorded. Media files fetched from presigned urls by tator.util helpers are not captured.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, urlencode, parse_qsl
+
+from tator.openapi.tator_openapi.rest import RESTResponse
+from tator.openapi.tator_openapi.exceptions import ApiException
+
+
+def request_key(method, path, query, body):
+    """ Identifies a request independently of host, query parameter order and json key order.
+        QUERY is a list of (key, value) pairs, BODY is raw bytes, a json-able object or None.
+    """
+    query = urlencode(sorted((str(k), str(v)) for k,v in query))
+    if isinstance(body, bytes):
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            pass
+    if isinstance(body, bytes):
+        body_hash = hashlib.sha1(body).hexdigest()
+    else:
+        body_hash = hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest() if body is not None else ''
+    return f'{method.upper()} {path}?{query} {body_hash}'
+
+
+class Recorder:
+    """ Appends every request/response made through a tator RESTClientObject to a json-lines fixture """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        open(path, 'w').close()
+
+    def write(self, key, status, content_type, data):
+        record = dict(key=key, status=status, content_type=content_type,
+                      data=base64.b64encode(data or b'').decode())
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record)+'\n')
+
+    def instrument(self, rest_client):
+        rest_request = rest_client.request
+        @wraps(rest_request)
+        def request(method, url, query_params=None, headers=None, body=None, post_params=None, **kwargs):
+            parts = urlsplit(url)
+            query = (query_params or []) + parse_qsl(parts.query)
+            key = request_key(method, parts.path, query, body if body is not None else post_params or None)
+            try:
+                response = rest_request(method, url, query_params=query_params, headers=headers,
+                                        body=body, post_params=post_params, **kwargs)
+            except ApiException as e:
+                data = e.body.encode() if isinstance(e.body, str) else e.body
+                self.write(key, e.status, (e.headers or {}).get('Content-Type'), data)
+                raise
+            if isinstance(response, RESTResponse):  # streamed (_preload_content=False) responses are not recorded
+                self.write(key, response.status, response.getheader('Content-Type'), response.data)
+            return response
+        rest_client.request = request
+
+
+class Fixture:
+    """ Recorded responses by request key. Repeated requests are answered in recorded order, the last one repeating. """
+    def __init__(self, path):
+        self.responses = defaultdict(list)
+        self.served = defaultdict(int)
+        self.lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                record['data'] = base64.b64decode(record['data'])
+                self.responses[record['key']].append(record)
+
+    def lookup(self, key):
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                return None
+            idx = min(self.served[key], len(responses)-1)
+            self.served[key] += 1
+            return responses[idx]
+
+
+def make_handler(fixture, latency=0, bandwidth=None, verbose=False):
+    """ BaseHTTPRequestHandler serving FIXTURE. LATENCY is seconds added before each response,
+        BANDWIDTH is in MB/s.
+    """
+    class ReplayHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+
+        def replay(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else None
+            parts = urlsplit(self.path)
+            key = request_key(self.command, parts.path, parse_qsl(parts.query), body)
+            record = fixture.lookup(key)
+            time.sleep(latency)
+            if record is None:
+                status, content_type, data = 404, 'application/json', json.dumps({'message':f'Not in fixture: {key}'}).encode()
+            else:
+                status, content_type, data = record['status'], record['content_type'], record['data']
+            self.send_response(status)
+            self.send_header('Content-Type', content_type or 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            chunk_size = 64*1024
+            for idx in range(0, len(data), chunk_size):
+                chunk = data[idx:idx+chunk_size]
+                self.wfile.write(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk)/(bandwidth*1e6))
+
+        do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = replay
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    return ReplayHandler
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Serve a fixture recorded with --record as a local tator host')
+    parser.add_argument('fixture', metavar='FIXTURE', help='json-lines fixture recorded with --record')
+    parser.add_argument('--port', type=int, default=8080, help='Default is 8080')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds of latency injected before every response')
+    parser.add_argument('--bandwidth', type=float, help='Response bandwidth limit in MB/s, per connection')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = cli()
+    fixture = Fixture(args.fixture)
+    handler = make_handler(fixture, args.latency, args.bandwidth, args.verbose)
+    server = ThreadingHTTPServer(('localhost', args.port), handler)
+    print(f'Replaying {sum(map(len, fixture.responses.values()))} responses from {args.fixture} at http://localhost:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    unserved = [key for key in fixture.responses if not fixture.served[key]]
+    print(f'Served {sum(fixture.served.values())} requests. {len(unserved)} recorded requests were never made')
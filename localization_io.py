@@ -0,0 +1,187 @@
+""" Reading and writing localization tables as CSV, Parquet or Feather.
+Parquet and Feather need pyarrow (see requirements.txt).
+"""
+
+import json
+import shutil
+
+import pandas as pd
+
+COLUMNAR_EXTS = ('.parquet', '.feather')
+CATEGORICAL_ATTRIBUTES = ('Class', 'ClassStrCorrection')
+
+
+def is_columnar(path):
+    return path.endswith(COLUMNAR_EXTS)
+
+
+def read_table(path, columns=None, dtype=None):
+    """ Reads a CSV, Parquet or Feather table into a DataFrame. Categorical columns stay categorical. """
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path, columns=columns)
+    elif path.endswith('.feather'):
+        df = pd.read_feather(path, columns=columns)
+    else:
+        return pd.read_csv(path, usecols=columns, dtype=dtype)
+    return df.astype(dtype) if dtype else df
+
+
+def write_table(df, path, index=False):
+    """ Writes DF as CSV, Parquet or Feather according to the extension of PATH """
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=index)
+    elif path.endswith('.feather'):
+        (df.reset_index() if index else df.reset_index(drop=True)).to_feather(path)
+    else:
+        df.to_csv(path, index=index)
+
+
+def merge_tables(paths, outfile):
+    """ Concatenates the tables at PATHS into OUTFILE, all of its format. When every input has the same
+        columns, CSV lines and Parquet row groups are copied over one file at a time; otherwise the
+        tables are read into memory and their columns unioned.
+    """
+    if outfile.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        files = [pq.ParquetFile(path) for path in paths]
+        schema = files[0].schema_arrow
+        if all(f.schema_arrow.equals(schema) for f in files):
+            with pq.ParquetWriter(outfile, schema) as writer:
+                for f in files:
+                    for idx in range(f.num_row_groups):
+                        writer.write_table(f.read_row_group(idx))
+            return
+    elif not is_columnar(outfile):
+        headers = []
+        for path in paths:
+            with open(path) as f:
+                headers.append(f.readline())
+        if len(set(headers)) == 1:
+            with open(outfile, 'w') as out:
+                out.write(headers[0])
+                for path in paths:
+                    with open(path) as f:
+                        f.readline()
+                        shutil.copyfileobj(f, out)
+            return
+    dfs = [read_table(path) for path in paths]
+    categoricals = {col for df in dfs for col in df if isinstance(df[col].dtype, pd.CategoricalDtype)}
+    df = pd.concat(dfs, ignore_index=True).astype({col:'category' for col in categoricals})
+    write_table(df, outfile)
+
+
+def localization_columns(loctype, imagepath=False):
+    """ (name, kind) of each column of the download_localizations output for localizations of LOCTYPE.
+        Kinds are int, float, float32, bool, category, timestamp and str. Attribute columns come from
+        the localization type definition, so every page of an export has the same columns.
+        Other attribute types (eg geopos) are str columns, holding json in Parquet and Feather.
+    """
+    columns = [('id', 'int'), ('media_id', 'int'), ('media', 'category'), ('frame', 'int'), ('frame_tiff', 'str'),
+               ('version_id', 'int'), ('version', 'category'), ('modified_by', 'category'), ('modified_datetime', 'timestamp'),
+               ('x', 'float32'), ('y', 'float32'), ('width', 'float32'), ('height', 'float32')]
+    attribute_kinds = dict(bool='bool', int='int', float='float', enum='category', datetime='timestamp')
+    for att in loctype.attribute_types:
+        columns.append((att.name, 'category' if att.name in CATEGORICAL_ATTRIBUTES else attribute_kinds.get(att.dtype, 'str')))
+    if imagepath:
+        columns.append(('imagepath', 'str'))
+    return columns
+
+
+def arrow_schema(columns):
+    import pyarrow as pa
+    types = dict(int=pa.int64(), float=pa.float64(), float32=pa.float32(), bool=pa.bool_(), str=pa.string(),
+                 category=pa.dictionary(pa.int32(), pa.string()), timestamp=pa.timestamp('us', tz='UTC'))
+    return pa.schema([(name, types[kind]) for name,kind in columns])
+
+
+def open_writer(path, columns):
+    """ Writer of localization pages to PATH, a ColumnarWriter or a CSVWriter according to its extension """
+    return ColumnarWriter(path, columns) if is_columnar(path) else CSVWriter(path, columns)
+
+
+class CSVWriter:
+    """ Appends DataFrame pages to a CSV as they arrive, after a header of COLUMNS.
+        Pages are conformed to COLUMNS: missing columns are left empty and extra columns are dropped.
+        Integer columns stay integers in pages with missing values.
+    """
+    def __init__(self, path, columns):
+        self.names = [name for name,kind in columns]
+        self.dtypes = {name:{'int':'Int64', 'bool':'boolean'}[kind] for name,kind in columns if kind in ('int','bool')}
+        self.file = open(path, 'w', newline='')
+        pd.DataFrame(columns=self.names).to_csv(self.file, index=False)
+        self.pages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, df):
+        df = df.reset_index() if df.index.name else df
+        df = df.reindex(columns=self.names).astype(self.dtypes)
+        df.to_csv(self.file, header=False, index=False)
+        self.pages += 1
+
+    def close(self):
+        self.file.close()
+
+
+def _text(value):
+    """ VALUE for a string column: lists and dicts (eg geopos attributes) as json, other non-strings as text """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value)
+    return None if pd.isna(value) else str(value)
+
+
+class ColumnarWriter:
+    """ Writes DataFrame pages as they arrive, one Parquet row group or Feather record batch per page.
+        Pages are conformed to COLUMNS: missing columns are written as nulls and extra columns are dropped.
+        Categories accumulate across pages, so every page shares one dictionary per categorical column.
+    """
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = schema = arrow_schema(columns)
+        self.categories = {field.name:{} for field in schema if pa.types.is_dictionary(field.type)}
+        self.pages = 0
+        if path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            options = pa.ipc.IpcWriteOptions(compression='lz4', emit_dictionary_deltas=True)
+            self.writer = pa.ipc.new_file(path, schema, options=options)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def column(self, field, values, length):
+        pa = self.pa
+        if values is None:
+            return pa.nulls(length, field.type)
+        if field.name in self.categories:
+            categories = self.categories[field.name]
+            values = values.where(values.isna(), values.astype(str))
+            for value in values.dropna().unique():
+                categories.setdefault(value, len(categories))
+            codes = pd.Categorical(values, categories=list(categories)).codes
+            indices = pa.array(codes, pa.int32(), mask=codes<0)
+            return pa.DictionaryArray.from_arrays(indices, pa.array(list(categories), pa.string()))
+        if pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(values.where(values != ''), utc=True).dt.floor('us')
+        elif pa.types.is_string(field.type):
+            values = values.map(_text)
+        return pa.array(values, field.type, from_pandas=True)
+
+    def write(self, df):
+        df = df.reset_index() if df.index.name else df
+        columns = [self.column(field, df[field.name] if field.name in df else None, len(df)) for field in self.schema]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+        self.pages += 1
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,99 @@
+import json
+import sqlite3
+
+import pandas as pd
+from tqdm import tqdm
+
+import api_util
+
+MODIFIED_DATETIME = '$modified_datetime'  # built-in field name for attribute filters
+
+
+class LocalizationStore:
+    """ Local SQLite copy of one localization selection (a get_localization_list query), keyed by localization id.
+        Rows are stored as formatted by download_localizations.format_localization_page.
+        sync() only fetches localizations modified since the last sync, and detects deletions by
+        comparing counts with the server, first for the whole selection and then per media.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS localizations (id INTEGER PRIMARY KEY, media_id INTEGER, modified_datetime TEXT, record TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS localizations_media ON localizations (media_id)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM localizations').fetchone()[0]
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?,?)', (key, value))
+
+    def high_water_mark(self):
+        return self.db.execute('SELECT MAX(modified_datetime) FROM localizations').fetchone()[0]
+
+    def upsert(self, page_df):
+        records = []
+        for record in page_df.reset_index().to_dict(orient='records'):
+            record = {k:(None if not isinstance(v, str) and pd.isna(v) else v) for k,v in record.items()}
+            records.append((record['id'], record['media_id'], record.get('modified_datetime') or None, json.dumps(record, default=str)))
+        self.db.executemany('INSERT OR REPLACE INTO localizations VALUES (?,?,?,?)', records)
+
+    def delete(self, ids):
+        self.db.executemany('DELETE FROM localizations WHERE id=?', [(i,) for i in ids])
+
+    def sync(self, api, project_id, query:dict, format_page, page_size=1000, workers=api_util.DEFAULT_WORKERS):
+        """ Brings the store up to date with the selection get_localization_list(PROJECT_ID, **QUERY).
+            FORMAT_PAGE turns a page of Localizations into a DataFrame indexed by id.
+            Returns (number of rows fetched, number of rows deleted).
+        """
+        selection = json.dumps(dict(host=api_util.api_host(api), project=project_id, query=query), sort_keys=True, default=str)
+        if self.get_meta('selection') not in (None, selection):
+            raise ValueError(f'{self.path} holds a different selection: {self.get_meta("selection")}')
+        self.set_meta('selection', selection)
+
+        # 1) everything modified at or after the newest record already stored (or everything, the first time)
+        hwm = self.high_water_mark()
+        delta_query = dict(query)
+        if hwm:
+            delta_query['attribute_gte'] = query.get('attribute_gte', []) + [f'{MODIFIED_DATETIME}::{hwm}']
+            print(f'  Fetching localizations modified since {hwm}')
+        fetched = 0
+        for page in tqdm(api_util.paginate(api, 'get_localization_list', page_size, project=project_id, **delta_query), desc='Pages'):
+            self.upsert(format_page(page))
+            fetched += len(page)
+        self.db.commit()
+
+        # 2) deletions. Equal counts mean nothing was deleted. Otherwise, find the media whose counts differ
+        #    and reconcile their ids.
+        deleted = 0
+        if api.get_localization_count(project_id, **query) != len(self):
+            local_counts = dict(self.db.execute('SELECT media_id, COUNT(*) FROM localizations GROUP BY media_id'))
+            media_ids = sorted(local_counts)
+            server_counts = api_util.concurrent_map(
+                lambda media_id: api.get_localization_count(project_id, **{**query, 'media_id':[media_id]}),
+                media_ids, workers, desc='Checking media for deletions')
+            for media_id, server_count in zip(media_ids, server_counts):
+                if server_count == local_counts[media_id]:
+                    continue
+                server_ids = {l.id for page in api_util.paginate(api, 'get_localization_list', page_size,
+                                                                 project=project_id, **{**query, 'media_id':[media_id]})
+                              for l in page}
+                local_ids = {row[0] for row in self.db.execute('SELECT id FROM localizations WHERE media_id=?', (media_id,))}
+                self.delete(local_ids-server_ids)
+                deleted += len(local_ids-server_ids)
+            self.db.commit()
+        return fetched, deleted
+
+    def iter_dataframes(self, page_size=1000):
+        """ Yields the stored localizations as DataFrames of at most PAGE_SIZE rows, indexed by id, in id order """
+        cursor = self.db.execute('SELECT record FROM localizations ORDER BY id')
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records([json.loads(row[0]) for row in rows], index='id')
@@ -11,6 +11,8 @@ from collections import defaultdict
 
 import tator
 
+import api_util
+
 logging.basicConfig(
     filename='migrate.log',
     filemode='w',
@@ -106,6 +108,7 @@ def parse_args():
     parser.add_argument('--ignore-media-transfer', help='If given, media will not be transferred but '
                                                         'the media objects will still be created.',
                         action='store_true')
+    api_util.add_api_args(parser)
     return parser.parse_args()
 
 def get_tator_user_sections(media):
@@ -118,9 +121,9 @@ def setup_apis(args):
     """ Sets up API objects.
     """
     # Set up API objects.
-    src_api = tator.get_api(host=args.host, token=args.token)
+    src_api = api_util.api_from_args(args)
     if (args.dest_host is not None) and (args.dest_token is not None):
-        dest_api = tator.get_api(host=args.dest_host, token=args.dest_token)
+        dest_api = api_util.api_from_args(args, host=args.dest_host, token=args.dest_token)
         logger.info(f"Migrating to different host (to {args.dest_host} from {args.host}).")
     else:
         dest_api = src_api
@@ -362,6 +365,14 @@ def find_media(args, src_api, dest_api, dest_project):
                          "already exist).")
     return media, media_mapping
 
+def _concurrent_list(list_func, project, media_ids, workers, chunk_size=100):
+    """ Calls a get_*_list function for chunks of media IDs concurrently and concatenates
+        the results in chunk order.
+    """
+    chunks = [media_ids[idx:idx+chunk_size] for idx in range(0, len(media_ids), chunk_size)]
+    pages = api_util.concurrent_map(lambda chunk: list_func(project, media_id=chunk), chunks, workers)
+    return [obj for page in pages for obj in page]
+
 def _is_num(x):
     return isinstance(x, float) or isinstance(x, int)
 
@@ -412,21 +423,14 @@ def find_localizations(args, src_api, dest_api, dest_project, media, media_mappi
     else:
         # Get existing localizations.
         dest_media_ids = list(media_mapping.values())
-        existing_loc = []
         print("Retrieving existing localizations...")
-        for idx in range(0, len(dest_media_ids), 100):
-            existing_loc += dest_api.get_localization_list(dest_project.id,
-                                                           media_id=dest_media_ids[idx:idx+100])
+        existing_loc = _concurrent_list(dest_api.get_localization_list, dest_project.id,
+                                        dest_media_ids, args.workers)
         # Get all source localizations.
-        src_media_ids = list(media_mapping.keys())
-        source_loc = []
+        src_media_ids = [m.id for m in media] + list(media_mapping.keys())
         print("Retrieving source localizations...")
-        for idx in range(0, len(media), 100):
-            source_loc += src_api.get_localization_list(args.project,
-                                                        media_id=[m.id for m in media[idx:idx+100]])
-        for idx in range(0, len(src_media_ids), 100):
-            source_loc += src_api.get_localization_list(args.project,
-                                                        media_id=src_media_ids[idx:idx+100])
+        source_loc = _concurrent_list(src_api.get_localization_list, args.project,
+                                      src_media_ids, args.workers)
         # Group source and dest localizations by source media ID and frame number.
         print("Building lookups by media/frame...")
         reverse_media = {v:k for k, v in media_mapping.items()}
@@ -481,21 +485,14 @@ def find_states(args, src_api, dest_api, dest_project, media, media_mapping,
     else:
         # Get existing states.
         dest_media_ids = list(media_mapping.values())
-        existing_states = []
         print("Retrieving existing states...")
-        for idx in range(0, len(dest_media_ids), 100):
-            existing_states += dest_api.get_state_list(dest_project.id,
-                                                       media_id=dest_media_ids[idx:idx+100])
+        existing_states = _concurrent_list(dest_api.get_state_list, dest_project.id,
+                                           dest_media_ids, args.workers)
         # Get all source states.
-        src_media_ids = list(media_mapping.keys())
-        source_states = []
+        src_media_ids = [m.id for m in media] + list(media_mapping.keys())
         print("Retrieving source states...")
-        for idx in range(0, len(media), 100):
-            source_states += src_api.get_state_list(args.project,
-                                                    media_id=[m.id for m in media[idx:idx+100]])
-        for idx in range(0, len(src_media_ids), 100):
-            source_states += src_api.get_state_list(args.project,
-                                                    media_id=src_media_ids[idx:idx+100])
+        source_states = _concurrent_list(src_api.get_state_list, args.project,
+                                         src_media_ids, args.workers)
         # Group source and dest states by source media ID and frame number.
         print("Building lookups by media/frame...")
         reverse_media = {v:k for k, v in media_mapping.items()}
@@ -1,17 +1,35 @@
 import argparse
 import os
+import json
+import math
+import bisect
+import hashlib
+import threading
+from itertools import islice, product
+from contextlib import nullcontext
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter as tictoc
 
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
-import math
-import tator
+from tator.openapi.tator_openapi.exceptions import ApiException
 
 import api_util
 
 
-def cli():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('src', metavar='CSV', help='CSV file of localizations to upload')
+MAX_BATCH_SIZE = 500  # create_localization_list limit
+MIN_BATCH_SIZE = 25
+CHUNK_SIZE = 50000  # CSV rows read at a time
+DEDUP_TOLERANCE = 0.01  # as migrate._same_localization
+PRECHECK_TOLERANCE = 1e-6
+SPLIT_STATUSES = {413, 429, 503}  # the server rejected the batch without creating any of it
+INTEGER_PATTERN = r'\s*[+-]?\d+\s*'  # CSV attribute values parsed as Int64
+
+
+def add_upload_args(parser):
+    """ Arguments shared with upload_localizations_list.py """
     parser.add_argument('--host', default='https://tator.whoi.edu', help='Tator Server URL')
     parser.add_argument('--token', required=True, help='A tator api token')
     parser.add_argument('--project', '-p', required=True, help='Name or ID of the Project being uploaded-to')
@@ -21,7 +39,13 @@ def cli():
     parser.add_argument('--col-drop', nargs='+', default=[], help='Columns from csv to drop prior to upload')
     parser.add_argument('--col-rename', metavar=('OLD','NEW'), nargs=2, action='append', help='Rename a column. Can be invoked more than once for multiple columns')
     parser.add_argument('--col-add', metavar=('NAME','CONTENT'), nargs=2, action='append', help='Adds a new column NAME populated homogenously with CONTENT. Can be invoked  more than once to create multiple new columns')
+    parser.add_argument('--precheck', action='store_true', help='For reruns after a crash that may have outrun the journal: the batches the crashed run could have created without journaling them are looked up on the server, and only their missing localizations are created')
+    parser.add_argument('--skip-existing', action='store_true', help=f'Skip rows already on the server: same media, frame and Class, and a box within {DEDUP_TOLERANCE} like migrate.py matches localizations. The localizations of the CSV media are fetched once up front')
+    parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE, help=f'Localizations per create request to start with, adapted to server latency. At most {MAX_BATCH_SIZE}, the default')
+    api_util.add_api_args(parser)
 
+
+def parse_upload_args(parser):
     args = parser.parse_args()
     if os.path.isfile(args.token):
         with open(args.token) as f:
@@ -33,65 +57,394 @@ def cli():
     return args
 
 
-def make_speclist(api,args):
-    speclist = []
+def cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src', metavar='CSV', help='CSV file of localizations to upload')
+    add_upload_args(parser)
+    parser.add_argument('--journal', help='File recording the batches already created, so that a rerun resumes rather than duplicating them. Default is CSV.journal.jsonl')
+
+    args = parse_upload_args(parser)
+    args.journal = args.journal or f'{args.src}.journal.jsonl'
+    return args
+
+
+def read_csv_chunks(args, columns, chunk_size=CHUNK_SIZE, dtype=None):
+    """ Yields DataFrames of CHUNK_SIZE rows of the CSV, with only COLUMNS (named after --col-rename).
+        DTYPE maps column names (named after --col-rename too) to read_csv dtypes.
+    """
+    rename = args.col_rename or {}
+    original = {new:old for old,new in rename.items()}
+    dtype = {original.get(col,col):col_dtype for col,col_dtype in (dtype or {}).items()}
+    for chunk in pd.read_csv(args.src, usecols=[original.get(col,col) for col in columns], chunksize=chunk_size, dtype=dtype):
+        yield chunk.rename(columns=rename)
+
+
+def attribute_dtype(values):
+    """ boolean, Int64, Float64 or string: the dtype of an attribute column from its non-NA VALUES as read from the CSV """
+    if values.str.lower().isin(['true','false']).all():
+        return 'boolean'
+    if values.str.fullmatch(INTEGER_PATTERN).all():
+        return 'Int64'
+    try:
+        pd.to_numeric(values)
+        return 'Float64'
+    except ValueError:
+        return 'string'
+
+
+def parse_attribute(values, dtype):
+    """ Converts VALUES as read from the CSV to DTYPE (see attribute_dtype). Integers are parsed exactly, even above 2**53 """
+    if dtype == 'boolean':
+        parsed = values.str.lower().map({'true':True, 'false':False})
+        if (parsed.isna() & values.notna()).any():
+            raise ValueError(f'not true or false: {values[parsed.isna() & values.notna()].iloc[0]!r}')
+        return parsed.astype('boolean')
+    if dtype == 'Int64':
+        return pd.Series([pd.NA if pd.isna(value) else int(value) for value in values], index=values.index, dtype='Int64')
+    if dtype == 'Float64':
+        return pd.to_numeric(values).astype('Float64')
+    return values.astype('string')
+
+
+def resolve_csv_media(api, args, chunk_size=CHUNK_SIZE):
+    """ {media name or id: media id} for the media of the CSV, resolved all at once from a pass over the media column only """
+    media_names = set()
+    for chunk in read_csv_chunks(args, ['media'], chunk_size):
+        media_names.update(chunk['media'].dropna().unique().tolist())
+    return api_util.resolve_media_ids(api, media_names, project=args.project_id)
+
+
+def make_speclist(api, args, media_id_mapping=None, chunk_size=CHUNK_SIZE):
+    """ Yields a localization spec per CSV row, in file order, so that specs are built while earlier ones upload.
+        The CSV is read CHUNK_SIZE rows at a time and each chunk is turned into specs column by column,
+        so memory stays constant however long the CSV is.
+    """
     required_headers = 'media,frame,x,y,width,height'.split(',')
-    addl_headers = []
+    header = pd.read_csv(args.src, nrows=0).rename(columns=args.col_rename or {}, errors='raise').columns
+    usecols = [col for col in header if col not in args.col_drop]
+    names = usecols + [col_name for col_name,col_content in args.col_add or []]
+    assert all([item in names for item in required_headers]), 'required headers missing'
+    addl_headers = [col for col in names if col not in required_headers and col not in ['version','type']]
+    # eg Class, Verified, ModelName, ModelScore
 
-    df = pd.read_csv(args.src)
-    if args.col_rename:
-        df.rename(columns=args.col_rename, inplace=True, errors="raise")
-    if args.col_add:
-        for col_name,col_content in args.col_add:
+    if media_id_mapping is None:
+        media_id_mapping = resolve_csv_media(api, args, chunk_size)
+
+    # dtypes are fixed for the whole file, so that specs (and their journal digests) don't depend on where chunks split.
+    # attribute columns are read as text and take their dtype from the first chunk in which they have values.
+    # an Int64 column with a fractional value later on becomes Float64, which sends the same json for whole numbers
+    dtypes = dict(frame='Int64', x='Float64', y='Float64', width='Float64', height='Float64')
+    dtypes.update({col_name:'string' for col_name,col_content in args.col_add or []})
+    csv_attributes = [col for col in addl_headers if col in usecols]
+    for chunk_num, df in enumerate(read_csv_chunks(args, usecols, chunk_size, dtype={col:str for col in csv_attributes})):
+        for col_name,col_content in args.col_add or []:
             df[col_name] = col_content
-    df = df.convert_dtypes()
-    print(df.T)
-    df = df.sort_values(by=required_headers)
-
-    assert all([item in list(df) for item in required_headers]), 'required headers missing'
-    for col in list(df):
-        if col not in required_headers and col not in ['version','type'] and col not in args.col_drop:
-            addl_headers.append(col)
-
-    for row in df.to_dict(orient="records"):
-        spec = {'media_id': api_util.get_media_id(api,row['media'], project=args.project_id),
-                'type': args.loctype_id,
-                'frame': row['frame'],
-                'x': row['x'],
-                'y': row['y'],
-                'width': row['width'],
-                'height': row['height'],
-                'version': args.version_id,
-               }
-        attrib_dict = {}
-        for custom_attribute in addl_headers:
-            if not isinstance(row[custom_attribute], pd._libs.missing.NAType):
-                attrib_dict[custom_attribute] = row[custom_attribute]
-                # eg Class, Verified, ModelName, ModelScore
-        spec['attributes'] = attrib_dict
-        speclist.append(spec)
-
-    return speclist
-
-
-def upload_speclist(api, speclist, project_id):
-    created_ids = []
-
-    # create_localization_list limited to 500 creations per request
+        for col in csv_attributes:
+            if col not in dtypes and df[col].notna().any():
+                dtypes[col] = attribute_dtype(df[col].dropna())
+        for col,dtype in dtypes.items():
+            try:
+                if col not in csv_attributes:
+                    df[col] = df[col].astype(dtype)
+                elif dtype == 'Int64' and not df[col].dropna().str.fullmatch(INTEGER_PATTERN).all():
+                    dtypes[col] = 'Float64'
+                    df[col] = parse_attribute(df[col], 'Float64')
+                else:
+                    df[col] = parse_attribute(df[col], dtype)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f'Column "{col}" is not {dtypes[col]} in rows {chunk_num*chunk_size}-{chunk_num*chunk_size+len(df)-1}: {e}')
+        if chunk_num == 0:
+            print(df.head().T)
+        media_ids = df['media'].map(media_id_mapping).tolist()
+        # object columns give python scalars rather than numpy ones, which the api client can't serialize
+        frames, xs, ys, widths, heights = (df[col].astype(object).tolist() for col in ['frame','x','y','width','height'])
+
+        # attributes column-wise, setting only the cells that aren't NA. whole numbers are sent as ints
+        attributes = [{} for _ in range(len(df))]
+        for col in addl_headers:
+            values = df[col].astype(object).tolist()
+            for idx in np.flatnonzero(df[col].notna().to_numpy()):
+                value = values[idx]
+                attributes[idx][col] = int(value) if isinstance(value, float) and value.is_integer() else value
+
+        for media_id, frame, x, y, width, height, attrib_dict in zip(media_ids, frames, xs, ys, widths, heights, attributes):
+            yield {'media_id': media_id,
+                   'type': args.loctype_id,
+                   'frame': frame,
+                   'x': x,
+                   'y': y,
+                   'width': width,
+                   'height': height,
+                   'version': args.version_id,
+                   'attributes': attrib_dict,
+                  }
+
+
+def specs_digest(specs):
+    return hashlib.sha1(json.dumps(specs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class UploadJournal:
+    """ The batches of an upload that the server created, one json line per batch with the spec rows it
+        covers [start, stop), the sha1 of those specs and the created ids. Lines are flushed as batches complete.
+        Each run also records how many batches it keeps in flight, which bounds the rows it may have created
+        without journaling them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.batches = {}
+        self.in_flight = None  # most batches in flight of any run so far
+        partial_line = False
+        if os.path.isfile(path):
+            with open(path) as f:
+                line = ''
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # last line of an interrupted run
+                        continue
+                    if 'start' in entry:
+                        self.batches[entry['start']] = entry
+                    else:
+                        self.in_flight = max(self.in_flight or 0, entry['in_flight'])
+            partial_line = bool(line) and not line.endswith('\n')
+        self.starts = sorted(self.batches)
+        self.file = open(path, 'a')
+        if partial_line:
+            self.file.write('\n')
+
+    def next_start(self, row):
+        """ Start of the first journaled batch at or after ROW, or None """
+        idx = bisect.bisect_left(self.starts, row)
+        return self.starts[idx] if idx < len(self.starts) else None
+
+    def start_run(self, in_flight):
+        self.file.write(json.dumps(dict(in_flight=in_flight))+'\n')
+        self.file.flush()
+
+    def add(self, start, specs, ids):
+        entry = dict(start=start, stop=start+len(specs), sha1=specs_digest(specs), ids=ids)
+        self.batches[start] = entry
+        self.file.write(json.dumps(entry)+'\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ExistingIndex:
+    """ Localizations already on the server, hashed so that the one a spec would duplicate is found without
+        comparing the spec to every localization of its media. Localizations match like in
+        migrate._same_localization: same media and frame, x, y, width and height within TOLERANCE, and the same
+        Class unless either has none. Boxes are hashed on their coordinates quantized to cells twice TOLERANCE
+        wide, so a spec's matches are in the 16 or fewer cells its tolerance window overlaps.
+    """
+    def __init__(self, tolerance=DEDUP_TOLERANCE):
+        self.tolerance = tolerance
+        self.cells = defaultdict(list)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def cell(self, value):
+        return math.floor(value/(2*self.tolerance))
+
+    def add(self, loc):
+        box = (loc.x or 0, loc.y or 0, loc.width or 0, loc.height or 0)
+        key = (loc.media, loc.frame) + tuple(self.cell(value) for value in box)
+        self.cells[key].append((loc.id, box, (loc.attributes or {}).get('Class')))
+        self.size += 1
+
+    def match(self, spec, claimed=()):
+        """ Id of a localization matching SPEC and not in CLAIMED, or None """
+        box = (spec['x'] or 0, spec['y'] or 0, spec['width'] or 0, spec['height'] or 0)
+        label = spec['attributes'].get('Class')
+        windows = [{self.cell(value-self.tolerance), self.cell(value+self.tolerance)} for value in box]
+        for cells in product(*windows):
+            for obj_id, other_box, other_label in self.cells.get((spec['media_id'], spec['frame'])+cells, ()):
+                if obj_id in claimed:
+                    continue
+                if all(abs(a-b) < self.tolerance for a,b in zip(box, other_box)) and \
+                        (label is None or other_label is None or label == other_label):
+                    return obj_id
+        return None
+
+    @classmethod
+    def fetch(cls, api, project_id, media_ids, version_id, loctype_id, tolerance=DEDUP_TOLERANCE,
+              media_chunk_size=100, workers=1):
+        """ Index of the localizations of MEDIA_IDS in VERSION_ID of LOCTYPE_ID, fetched for MEDIA_CHUNK_SIZE media at a time """
+        index = cls(tolerance)
+        media_ids = sorted(media_ids)
+        def fetch_chunk(chunk):
+            return [loc for page in api_util.paginate(api, 'get_localization_list', project=project_id, media_id=chunk,
+                                                      version=[version_id], type=loctype_id)
+                    for loc in page]
+        chunks = [media_ids[idx:idx+media_chunk_size] for idx in range(0, len(media_ids), media_chunk_size)]
+        for locs in api_util.concurrent_map(fetch_chunk, chunks, workers):
+            for loc in locs:
+                index.add(loc)
+        return index
+
+
+def upload_speclist(api, speclist, project_id, in_flight=api_util.DEFAULT_WORKERS, batch_size=MAX_BATCH_SIZE, target_latency=10,
+                    journal:UploadJournal=None, precheck=False, existing:ExistingIndex=None, pool:ThreadPoolExecutor=None, desc=None):
+    """ Creates the localizations of SPECLIST, any iterable of specs (eg make_speclist while it is still
+        building them), with up to IN_FLIGHT create_localization_list requests at once.
+        Returns the created ids in SPECLIST order.
+        Batches start at BATCH_SIZE specs. A batch slower than TARGET_LATENCY seconds halves the size of the
+        next ones and a batch faster than half of it grows it again. A batch the server rejected without
+        creating anything (413, or 429/503 once retries are exhausted) is split in two and resubmitted.
+        If a batch fails otherwise, in-flight batches are finished and a ConcurrentError is raised whose
+        results are the ids created per batch (None for failed batches).
+        With a JOURNAL, every created batch is recorded in it and the spec rows it already records are skipped,
+        after checking they are unchanged. Batches that finish are journaled even if SPECLIST raises.
+        With PRECHECK, the rows a previous run may have created without journaling them (the rows missing
+        between journaled batches, and as many rows after the last one as that run could have in flight,
+        ie its in flight batches at MAX_BATCH_SIZE) are looked up on the server first, and their localizations already there are not created again; their existing ids are
+        used, each for one spec only. EXISTING does the same for every batch from an index fetched beforehand
+        (see ExistingIndex), and its tolerance applies to PRECHECK too.
+        Requests run in POOL if given, eg one shared by concurrent uploads, else in a pool of IN_FLIGHT threads.
+    """
     print('Uploading Localizations...')
-    speclist500s = [speclist[i:i+500] for i in range(0, len(speclist), 500)]
-    for speclist500 in tqdm(speclist500s):
-        obj_ids = api.create_localization_list(project_id, speclist500)
-        created_ids.extend(obj_ids.id)
+    claimed = {obj_id for entry in journal.batches.values() for obj_id in entry['ids']} if journal is not None else set()
+    claim_lock = threading.Lock()
+
+    def create(batch, prechecked):
+        """ Returns (ids, latency, split, number of ids that already existed) """
+        if not prechecked and existing is None:
+            return (*create_missing(batch), 0)
+        if prechecked:
+            index = ExistingIndex.fetch(api, project_id, {spec['media_id'] for spec in batch}, batch[0]['version'],
+                                        batch[0]['type'], existing.tolerance if existing else PRECHECK_TOLERANCE)
+        else:
+            index = existing
+        existing_ids = []
+        with claim_lock:
+            for spec in batch:
+                existing_ids.append(index.match(spec, claimed))
+                claimed.add(existing_ids[-1])
+        missing = [spec for spec,obj_id in zip(batch, existing_ids) if obj_id is None]
+        created_ids, latency, split = create_missing(missing) if missing else ([], 0, False)
+        claimed.update(created_ids)
+        created_ids = iter(created_ids)
+        return [obj_id if obj_id is not None else next(created_ids) for obj_id in existing_ids], latency, split, len(batch)-len(missing)
+
+    def create_missing(batch):
+        tic = tictoc()
+        try:
+            return api.create_localization_list(project_id, batch).id, tictoc()-tic, False
+        except ApiException as e:
+            if e.status not in SPLIT_STATUSES or len(batch) == 1:
+                raise
+            half = len(batch)//2
+            return create_missing(batch[:half])[0] + create_missing(batch[half:])[0], tictoc()-tic, True
+
+    specs = iter(speclist)
+    batch_size = max(MIN_BATCH_SIZE, min(batch_size, MAX_BATCH_SIZE))
+    batch_results, errors = [], []
+    pending = {}  # future: (batch index, first row, batch, prechecked)
+    row = 0
+    journal_stop = max((entry['stop'] for entry in journal.batches.values()), default=0) if journal is not None else 0
+    # journals of older runs don't record in_flight, this run's is the best guess
+    previous_in_flight = (journal.in_flight if journal is not None else None) or in_flight
+    precheck_stop = journal_stop + previous_in_flight*MAX_BATCH_SIZE
+    if journal is not None:
+        journal.start_run(in_flight)
+    skipped = 0
+    present = 0
 
+    def finish(future):
+        nonlocal batch_size, present
+        idx, start, batch, prechecked = pending.pop(future)
+        try:
+            ids, latency, split, reused = future.result()
+        except Exception as e:
+            errors.append((idx, None, e))
+            return
+        batch_results[idx] = ids
+        present += reused
+        if journal is not None:
+            journal.add(start, batch, ids)
+        pbar.update(len(ids))
+        if split or latency > target_latency:
+            batch_size = max(MIN_BATCH_SIZE, batch_size//2)
+        elif latency < target_latency/2:
+            batch_size = min(MAX_BATCH_SIZE, batch_size+MIN_BATCH_SIZE)
+
+    tic = tictoc()
+    with (nullcontext(pool) if pool else ThreadPoolExecutor(in_flight)) as pool, tqdm(unit='rows', desc=desc) as pbar:
+        exhausted = False
+        try:
+            while pending or not (exhausted or errors):
+                # new batches are built (reading specs from SPECLIST) while the submitted ones are in flight
+                while not (exhausted or errors) and len(pending) < in_flight:
+                    if journal is not None and row in journal.batches:
+                        entry = journal.batches[row]
+                        journaled = list(islice(specs, entry['stop']-row))
+                        assert specs_digest(journaled) == entry['sha1'], \
+                            f'Rows {row}-{entry["stop"]} differ from those recorded in {journal.path}. Was the CSV changed? Remove the journal to upload from scratch'
+                        batch_results.append(entry['ids'])
+                        row = entry['stop']
+                        skipped += len(journaled)
+                        continue
+                    next_start = journal.next_start(row) if journal is not None else None
+                    # prechecked batches run alone, else one could take localizations another batch just created for its own
+                    prechecked = precheck and row < precheck_stop
+                    if pending and (prechecked or any(entry[3] for entry in pending.values())):
+                        break
+                    batch = list(islice(specs, batch_size if next_start is None else min(batch_size, next_start-row)))
+                    if not batch:
+                        exhausted = True
+                        break
+                    pending[pool.submit(create, batch, prechecked)] = len(batch_results), row, batch, prechecked
+                    batch_results.append(None)
+                    row += len(batch)
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+        finally:
+            # eg SPECLIST failed: batches already sent are still journaled
+            for future in list(pending):
+                future.exception()
+                finish(future)
+    if errors:
+        raise api_util.ConcurrentError(errors, batch_results)
+
+    created_ids = [obj_id for ids in batch_results for obj_id in ids]
+    elapsed = tictoc()-tic
+    if skipped:
+        print(f'Skipped {skipped} localizations already created according to {journal.path}')
+    if present:
+        print(f'Skipped {present} localizations already on the server')
+    created = len(created_ids)-skipped-present
+    print(f'Created {created} localizations in {elapsed:.1f}s ({(len(created_ids)-skipped)/max(elapsed,1e-9):.0f} rows/s)')
     return created_ids
 
 
 
+def upload_csv(api, args, pool:ThreadPoolExecutor=None, desc=None):
+    """ Uploads the localizations of ARGS.src as configured by the add_upload_args options, once
+        add_arg_ids has resolved them. Returns the ids of the CSV localizations.
+    """
+    media_id_mapping = resolve_csv_media(api, args)
+    existing = None
+    if args.skip_existing:
+        existing = ExistingIndex.fetch(api, args.project_id, set(media_id_mapping.values()), args.version_id, args.loctype_id,
+                                       workers=args.workers)
+        print(f'{len(existing)} localizations already in version {args.version} of the media of {args.src}')
+    speclist = make_speclist(api, args, media_id_mapping)
+    journal = UploadJournal(args.journal)
+    try:
+        return upload_speclist(api, speclist, args.project_id, args.workers, args.batch_size,
+                               journal=journal, precheck=args.precheck, existing=existing, pool=pool, desc=desc)
+    finally:
+        journal.close()
+
 
 if __name__ == '__main__':
     args = cli()
-    api = tator.get_api(args.host, args.token)
+    api = api_util.api_from_args(args)
 
     if args.force_version:
         api_util.get_version(api, args.version,
@@ -99,12 +452,7 @@ if __name__ == '__main__':
 
     api_util.add_arg_ids(api,args)
 
-    speclist = make_speclist(api,args)
-    #print(speclist[:2])
-    created_ids = upload_speclist(api, speclist, args.project_id)
+    created_ids = upload_csv(api, args)
     print(created_ids)
 
-    print(f'DONE! Created {len(created_ids)} localizations')
-
-
-
+    print(f'DONE! {len(created_ids)} localizations of {args.src} are on the server')
@@ -0,0 +1,97 @@
+""" Uploads the localization CSVs listed in a file, all in one process.
+Project, version and type are resolved once, one API session (and its metadata caches) serves every CSV,
+and create requests of all the CSVs share one pool of --workers threads. A status line per CSV is written
+to the --status file as CSVs finish. Each CSV keeps its own upload journal (CSV.journal.jsonl), so rerunning
+the list only uploads what is missing.
+"""
+
+import os
+import sys
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import perf_counter as tictoc
+
+import pandas as pd
+
+import api_util
+import csv_util
+import upload_localizations
+
+
+def cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src', metavar='CSV_LIST', help='File listing the CSV files to upload, one per line')
+    upload_localizations.add_upload_args(parser)
+    parser.add_argument('--check-classes', action='store_true', help='Before uploading a CSV, check that its Class values are leaves of the project, like "csv_util.py --action check_classes". CSVs that fail are not uploaded')
+    parser.add_argument('--files', type=int, default=2, help='CSVs uploaded at once. Default is 2')
+    parser.add_argument('--status', help='Status report written as CSVs finish. Default is CSV_LIST.status.csv')
+    api_util.add_shard_arg(parser, items='CSVs whose line number (from 0)')
+
+    args = upload_localizations.parse_upload_args(parser)
+    args.status = args.status or api_util.shard_path(f'{args.src}.status.csv', args.shard)
+    return args
+
+
+def read_csv_list(path, shard=None):
+    with open(path) as f:
+        csvs = [line.strip() for line in f if line.strip()]
+    return [csv for idx,csv in enumerate(csvs) if api_util.in_shard(idx, shard)]
+
+
+def status_table(statuses:dict):
+    """ STATUSES in CSV list order """
+    columns = ['csv','status','localizations','seconds','error']
+    return pd.DataFrame([statuses[idx] for idx in sorted(statuses)], columns=columns).astype({'localizations':'Int64'})
+
+
+def upload_one(api, args, src, pool):
+    """ Checks and uploads one CSV. Returns its status dict """
+    tic = tictoc()
+    status = dict(csv=src, status='uploaded', localizations=None, seconds=None, error=None)
+    file_args = argparse.Namespace(**{**vars(args), 'src':src, 'journal':f'{src}.journal.jsonl'})
+    try:
+        if not os.path.isfile(src):
+            raise FileNotFoundError(src)
+        if args.check_classes:
+            classes = set()
+            for chunk in upload_localizations.read_csv_chunks(file_args, ['Class']):
+                classes.update(chunk['Class'].unique().tolist())
+            csv_util.check_classes(api, args.project_id, classes)
+        ids = upload_localizations.upload_csv(api, file_args, pool=pool, desc=os.path.basename(src))
+        status['localizations'] = len(ids)
+    except Exception as e:
+        traceback.print_exc()
+        status['status'] = 'failed'
+        status['error'] = f'{type(e).__name__}: {e}'
+    status['seconds'] = round(tictoc()-tic, 1)
+    print(f'{status["status"].upper()}: {src}')
+    return status
+
+
+if __name__ == '__main__':
+    args = cli()
+    api = api_util.api_from_args(args)
+
+    if args.force_version:
+        api_util.get_version(api, args.version,
+            project=args.project, autocreate=args.force_version)
+
+    api_util.add_arg_ids(api,args)
+
+    csvs = read_csv_list(args.src, args.shard)
+    print(f'{len(csvs)} CSVs to upload' + (f' (shard {args.shard[0]}/{args.shard[1]})' if args.shard else ''))
+
+    statuses = {}  # list index: status
+    with ThreadPoolExecutor(args.workers) as request_pool, ThreadPoolExecutor(args.files) as file_pool:
+        futures = {file_pool.submit(upload_one, api, args, src, request_pool):idx for idx,src in enumerate(csvs)}
+        for future in as_completed(futures):
+            statuses[futures[future]] = future.result()
+            status_table(statuses).to_csv(args.status, index=False)
+
+    report = status_table(statuses)
+    print(report.drop(columns='error').to_string(index=False))
+    failed = report[report.status=='failed']
+    print(f'DONE! {len(report)-len(failed)} of {len(report)} CSVs uploaded, {report.localizations.sum():.0f} localizations. Status: {args.status}')
+    if len(failed):
+        sys.exit(1)
@@ -26,6 +26,7 @@ def get_args():
     tator_args.add_argument('--token', required=True, help='Tator user-access token (required)')
     tator_args.add_argument('--media_type', required=True, help='Name or ID of MediaType (required). If name, PROJECT must also be specified')
     tator_args.add_argument('--project', help='Name or ID of project. Only required when MEDIA_TYPE given is a Name')  # isiis
+    api_util.add_api_args(parser)
 
     args = parser.parse_args()
     
@@ -39,7 +40,7 @@ if __name__ == '__main__':
 
     # 0) inputs: CSV, ifcb dashboard params, tator_configs
     args = get_args()
-    api = tator.get_api(args.host, args.token)
+    api = api_util.api_from_args(args)
     args.media_type_id = api_util.get_mediatype(api,args.media_type,project=args.project)
 
     # 1) ingest csv
@@ -3,7 +3,6 @@
 import os
 import argparse
 import pandas as pd
-import tator
 from tator.openapi.tator_openapi.models import StateSpec
 
 import api_util
@@ -16,6 +15,7 @@ def get_parser():
     tator_args.add_argument('--host', default='https://tator.whoi.edu', help='Default is "https://tator.whoi.edu"')
     tator_args.add_argument('--token', required=True, help='Tator user-access token (required)')
     parser.add_argument('--project', '-p', required=True, help='Name or ID of the Project (required)')
+    api_util.add_api_args(parser)
     #parser.add_argument('--version', '-v', required=True, help='Name or ID of the Version (required)')
     #parser.add_argument('--statetype', '-s', required=True, help='Name or ID of the StateType (required)')
 
@@ -37,7 +37,7 @@ if __name__ == '__main__':
 
     # 0) inputs: CSV, state type and version
     args = cli()
-    api = tator.get_api(args.host, args.token)
+    api = api_util.api_from_args(args)
     args.project_id = api_util.get_project_id(api, args.project)
     #args.version_id = api_util.get_version(api, args.version, project=args.project_id).id
     #args.statetype_id = api_util.get_statetype(api,args.statetype,project=args.project_id).id